@@ -1,27 +1,85 @@
+import asyncio
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import NamedTuple, Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from database import get_db, User
+from sqlalchemy import event, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from cache import LRUCache
+from database import get_async_db, user_credentials, User
 
 # Secret key to sign JWT tokens (In production, use a strong random secret!)
 SECRET_KEY = "super-secret-key-change-this-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
+# Verified tokens are remembered so authenticated requests skip the users lookup
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL_SECONDS = int(os.getenv("AUTH_CACHE_TTL_SECONDS", "300"))
+# bcrypt gets its own small pool so a burst of logins queues here instead
+# of taking every threadpool slot from queries and uploads
+AUTH_HASH_WORKERS = int(os.getenv("AUTH_HASH_WORKERS", "2"))
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+class AuthUser(NamedTuple):
+    id: int
+    username: str
+
+class CachedToken(NamedTuple):
+    user: AuthUser
+    # Tells sync_token_cache() the password was changed by another process
+    hashed_password: str
+
+token_cache = LRUCache(AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL_SECONDS)
+_hash_executor = ThreadPoolExecutor(AUTH_HASH_WORKERS, thread_name_prefix="bcrypt")
+
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+async def verify_password_async(plain_password, hashed_password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_hash_executor, verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_hash_executor, get_password_hash, password)
+
+def invalidate_user(username: str):
+    # Forget every cached token of this user
+    return token_cache.remove_where(lambda token, entry: entry.user.username == username)
+
+def sync_token_cache():
+    """Forget cached tokens of users deleted, renamed or given a new password
+    by another worker process, which the ORM events here never see. Called
+    periodically (see index_sync.py); returns the number of tokens dropped."""
+    users = {entry.user.id for entry in token_cache.values()}
+    if not users:
+        return 0
+    current = user_credentials(users)
+    return token_cache.remove_where(
+        lambda token, entry: current.get(entry.user.id) != (entry.user.username, entry.hashed_password))
+
+@event.listens_for(User, "after_delete")
+def _user_deleted(mapper, connection, target):
+    invalidate_user(target.username)
+
+@event.listens_for(User, "after_update")
+def _user_updated(mapper, connection, target):
+    state = inspect(target)
+    if state.attrs.hashed_password.history.has_changes() or state.attrs.username.history.has_changes():
+        for username in {target.username, *state.attrs.username.history.deleted}:
+            invalidate_user(username)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -32,7 +90,11 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached.user
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -46,7 +108,11 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     except JWTError:
         raise credentials_exception
     
-    user = db.query(User).filter(User.username == username).first()
-    if user is None:
+    result = await db.execute(select(User.id, User.username, User.hashed_password).where(User.username == username))
+    row = result.first()
+    if row is None:
         raise credentials_exception
+    user = AuthUser(row.id, row.username)
+    # Never serve a token from the cache past its own expiry
+    token_cache.put(token, CachedToken(user, row.hashed_password), ttl=max(0, payload["exp"] - time.time()))
     return user
@@ -0,0 +1,122 @@
+"""Synthetic text and PDF corpora, sized in chunks, for the benchmark suite.
+
+    python -m benchmarks.corpus --users 10 --chunks 100000 --pdfs 20 --out corpus
+
+Words are drawn from a Zipf-distributed vocabulary, so BM25 sees skewed term
+statistics like real text, and two chunks practically never repeat (content
+dedup would otherwise shrink the corpus). Writes one text file per document
+and the PDFs, rendered with reportlab, plus a manifest.json listing them.
+"""
+import argparse
+import json
+import os
+import numpy as np
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+
+# rag.iter_chunks uses 500-character windows that overlap by 100, so every
+# chunk after the first adds 400 new characters; a text of exactly
+# CHARS_PER_CHUNK * n characters yields n chunks
+CHARS_PER_CHUNK = 400
+
+WORDS = ["retrieval", "augmented", "generation", "vector", "index", "chunk", "document",
+         "query", "embedding", "latency", "throughput", "model", "invoice", "contract"]
+VOCABULARY_SIZE = 5000
+
+# PDF layout: characters per line and lines per page at 9pt Helvetica on A4
+LINE_CHARS = 100
+PAGE_LINES = 70
+
+
+class Corpus:
+    """Deterministic generator of documents and questions for one seed."""
+
+    def __init__(self, seed=0, vocabulary_size=VOCABULARY_SIZE):
+        self.rng = np.random.default_rng(seed)
+        # Real words first, so the most frequent terms read like the domain
+        self.vocabulary = np.array(WORDS + [f"term{i}" for i in range(vocabulary_size - len(WORDS))])
+        weights = 1.0 / np.arange(1, vocabulary_size + 1)
+        self.p = weights / weights.sum()
+        self._mean_length = float((np.char.str_len(self.vocabulary) + 1) @ self.p)
+
+    def words(self, n):
+        return self.rng.choice(self.vocabulary, size=n, p=self.p)
+
+    def text(self, chunks):
+        # Exactly CHARS_PER_CHUNK * chunks characters
+        length = CHARS_PER_CHUNK * chunks
+        parts, total = [], 0
+        while total < length:
+            part = " ".join(self.words(int((length - total) / self._mean_length) + 16)) + " "
+            parts.append(part)
+            total += len(part)
+        return "".join(parts)[:length]
+
+    def question(self, words=3):
+        return " ".join(self.words(words))
+
+    def documents(self, chunks, users, doc_chunks):
+        """Yield (user_index, filename, chunks) splitting ``chunks`` into
+        documents of ``doc_chunks``, dealt round-robin to the users."""
+        for i, start in enumerate(range(0, chunks, doc_chunks)):
+            yield i % users, f"doc{i:06d}.txt", min(doc_chunks, chunks - start)
+
+    def write_pdf(self, path, chunks):
+        write_pdf(path, self.text(chunks))
+
+
+def write_pdf(path, text):
+    pdf = canvas.Canvas(path, pagesize=A4)
+    pdf.setFont("Helvetica", 9)
+    lines = _wrap(text, LINE_CHARS)
+    for start in range(0, len(lines), PAGE_LINES):
+        for row, line in enumerate(lines[start:start + PAGE_LINES]):
+            pdf.drawString(30, 800 - 11 * row, line)
+        pdf.showPage()
+    pdf.save()
+
+
+def _wrap(text, width):
+    lines, line = [], []
+    length = 0
+    for word in text.split(" "):
+        if line and length + len(word) > width:
+            lines.append(" ".join(line))
+            line, length = [], 0
+        line.append(word)
+        length += len(word) + 1
+    if line:
+        lines.append(" ".join(line))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--chunks", type=int, default=10000, help="Text chunks in total, across all users")
+    parser.add_argument("--doc-chunks", type=int, default=100, help="Chunks per text document")
+    parser.add_argument("--pdfs", type=int, default=4)
+    parser.add_argument("--pdf-chunks", type=int, default=200, help="Chunks per PDF")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="corpus")
+    args = parser.parse_args()
+
+    corpus = Corpus(args.seed)
+    os.makedirs(args.out, exist_ok=True)
+    manifest = {"users": args.users, "documents": [], "pdfs": []}
+    for user, filename, chunks in corpus.documents(args.chunks, args.users, args.doc_chunks):
+        with open(os.path.join(args.out, filename), "w") as f:
+            f.write(corpus.text(chunks))
+        manifest["documents"].append({"user": user, "file": filename, "chunks": chunks})
+    for i in range(args.pdfs):
+        filename = f"doc{i:06d}.pdf"
+        corpus.write_pdf(os.path.join(args.out, filename), args.pdf_chunks)
+        manifest["pdfs"].append({"user": i % args.users, "file": filename, "chunks": args.pdf_chunks})
+    with open(os.path.join(args.out, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Wrote {len(manifest['documents'])} text documents ({args.chunks} chunks) and "
+          f"{args.pdfs} PDFs to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Recall@k vs latency of the approximate index backends against exact search.
+
+    python -m benchmarks.index_recall --chunks 100000 --nlist 256 --nprobe 1,4,16,64
+"""
+import argparse
+import json
+import time
+import numpy as np
+
+from vector_index import ExactIndex, IVFIndex
+
+EMBED_DIM = 384
+
+
+def synthetic_embeddings(n, dim=EMBED_DIM, clusters=1000, seed=0):
+    # Real embeddings are clustered by topic, uniform noise would be the
+    # worst case for any coarse quantizer.
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=n)
+    noise = rng.standard_normal((n, dim)).astype(np.float32) * 0.6
+    return centers[labels] + noise
+
+
+def timed_search(index, queries, k, **kwargs):
+    latencies, results = [], []
+    for q in queries:
+        start = time.perf_counter()
+        ids, _ = index.search(q, k, **kwargs)
+        latencies.append(time.perf_counter() - start)
+        results.append(ids)
+    return results, np.array(latencies) * 1000
+
+
+def recall_at_k(truth, found):
+    hits = sum(len(np.intersect1d(t, f)) for t, f in zip(truth, found))
+    return hits / sum(len(t) for t in truth)
+
+
+def summarize(name, latencies_ms, recall, **extra):
+    return {
+        "backend": name,
+        **extra,
+        "recall": round(recall, 4),
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 3),
+        "p99_ms": round(float(np.percentile(latencies_ms, 99)), 3),
+        "qps": round(1000 / float(latencies_ms.mean()), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=256)
+    parser.add_argument("--nprobe", default="1,4,8,16,32,64")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    data = synthetic_embeddings(args.chunks + args.queries)
+    vectors, queries = data[:args.chunks], data[args.chunks:]
+    ids = np.arange(args.chunks, dtype=np.int64)
+
+    exact = ExactIndex()
+    exact.add(ids, vectors)
+    truth, latencies = timed_search(exact, queries, args.k)
+    results = [summarize("exact", latencies, 1.0)]
+
+    start = time.perf_counter()
+    ivf = IVFIndex(nlist=args.nlist)
+    ivf.add(ids, vectors)
+    build_s = time.perf_counter() - start
+    for nprobe in (int(p) for p in args.nprobe.split(",")):
+        found, latencies = timed_search(ivf, queries, args.k, nprobe=nprobe)
+        results.append(summarize("ivf", latencies, recall_at_k(truth, found),
+                                 nlist=args.nlist, nprobe=nprobe, build_s=round(build_s, 2)))
+
+    print(f"{args.chunks} chunks, {args.queries} queries, recall@{args.k}")
+    print(f"{'backend':<8}{'nprobe':>8}{'recall':>10}{'p50 ms':>10}{'p99 ms':>10}{'qps':>10}")
+    for r in results:
+        print(f"{r['backend']:<8}{r.get('nprobe', '-'):>8}{r['recall']:>10.4f}{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['qps']:>10.1f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Chunk write throughput: the old per-object ORM path against the bulk path.
+
+    python -m benchmarks.ingest --chunks 10000,100000,1000000
+
+Each run gets a fresh SQLite database and embedding store in a temp
+directory. Embeddings are precomputed so only the write path is timed.
+
+  orm   one DocumentChunk object per chunk, vector stored as a SQL blob,
+        default SQLite journal (how process_and_save_pdf_text used to write)
+  bulk  Core INSERT ... RETURNING per batch with content-hash dedup and
+        file_chunks rows, vectors appended to the embedding store once the
+        batch commits, WAL + synchronous=NORMAL (the current path)
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import Base, DocumentChunk, UploadedFile, User, create_db_engine, insert_file_chunks, insert_unique_chunks
+from embedding_store import EmbeddingStore, EMBED_DIM
+
+CHUNK_CHARS = 500
+
+
+def synthetic_chunks(n, seed=0):
+    # A small pool of random texts, made unique by a prefix, keeps generation
+    # cost out of the measurement
+    rng = np.random.default_rng(seed)
+    words = np.array(["retrieval", "augmented", "generation", "vector", "index", "chunk",
+                      "document", "query", "embedding", "latency", "throughput", "model"])
+    pool = [" ".join(rng.choice(words, size=80)) for _ in range(1000)]
+    for i in range(n):
+        yield f"[{i}] {pool[i % len(pool)]}"[:CHUNK_CHARS]
+
+
+def _setup(engine):
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    user = User(username="bench", hashed_password="x")
+    db.add(user)
+    db.flush()
+    new_file = UploadedFile(filename="bench.pdf", upload_date=datetime(2024, 1, 1), user_id=user.id)
+    db.add(new_file)
+    db.commit()
+    return db, user.id, new_file.id
+
+
+def run_orm(workdir, n, batch_size, embeddings):
+    engine = create_engine(f"sqlite:///{workdir}/orm.db")
+    db, user_id, file_id = _setup(engine)
+    start = time.perf_counter()
+    for i, content in enumerate(synthetic_chunks(n)):
+        db.add(DocumentChunk(content=content, embedding=embeddings[i % len(embeddings)].tobytes(),
+                             user_id=user_id, file_id=file_id))
+        if (i + 1) % batch_size == 0:
+            db.commit()
+    db.commit()
+    elapsed = time.perf_counter() - start
+    db.close()
+    engine.dispose()
+    return elapsed
+
+
+def run_bulk(workdir, n, batch_size, embeddings):
+    engine = create_db_engine(f"sqlite:///{workdir}/bulk.db", writer=True)
+    store = EmbeddingStore(os.path.join(workdir, "embeddings"))
+    db, user_id, file_id = _setup(engine)
+    start = time.perf_counter()
+    batch, position = [], 0
+    for content in synthetic_chunks(n):
+        batch.append(content)
+        if len(batch) == batch_size:
+            _write_batch(db, store, batch, position, user_id, file_id, embeddings)
+            position += len(batch)
+            batch = []
+    if batch:
+        _write_batch(db, store, batch, position, user_id, file_id, embeddings)
+    elapsed = time.perf_counter() - start
+    db.close()
+    engine.dispose()
+    return elapsed
+
+
+def _write_batch(db, store, batch, position, user_id, file_id, embeddings):
+    # Same hashing as rag.chunk_hash; synthetic chunks are unique, so every
+    # row is inserted
+    hashes = [hashlib.sha256(c.encode("utf-8")).hexdigest() for c in batch]
+    inserted = insert_unique_chunks(db, batch, hashes, user_id, file_id)
+    chunk_ids = [inserted[h] for h in hashes]
+    insert_file_chunks(db, file_id, position, chunk_ids)
+    store.append(user_id, chunk_ids, embeddings[:len(batch)], commit=db.commit)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", default="10000,100000")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--paths", default="orm,bulk")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    runners = {"orm": run_orm, "bulk": run_bulk}
+    embeddings = np.random.default_rng(0).standard_normal((args.batch_size, EMBED_DIM)).astype(np.float32)
+    results = []
+    print(f"{'path':<6}{'chunks':>10}{'seconds':>10}{'chunks/s':>12}")
+    for n in (int(c) for c in args.chunks.split(",")):
+        for path in args.paths.split(","):
+            workdir = tempfile.mkdtemp(prefix="bench_ingest_")
+            try:
+                elapsed = runners[path](workdir, n, args.batch_size, embeddings)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+            result = {"path": path, "chunks": n, "batch_size": args.batch_size,
+                      "seconds": round(elapsed, 3), "chunks_per_second": round(n / elapsed, 1)}
+            results.append(result)
+            print(f"{path:<6}{n:>10}{elapsed:>10.2f}{n / elapsed:>12.0f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
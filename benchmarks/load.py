@@ -0,0 +1,174 @@
+"""Concurrent /query latency: the async handlers against the old blocking path.
+
+    python -m benchmarks.load --users 4 --chunks 20000 --concurrency 32 --requests 1000
+
+Seeds a throwaway working directory (database, embedding store, uploads),
+starts a real uvicorn server there and drives it over HTTP, so latencies
+include time spent queued behind a blocked event loop.
+
+  blocking  sync Session and retrieval called directly inside the async
+            handler, as /query used to; every request stalls the event loop
+  async     the real /query: async session, retrieval math in an executor
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = ["retrieval", "augmented", "generation", "vector", "index", "chunk", "document",
+         "query", "embedding", "latency", "throughput", "model", "invoice", "contract"]
+
+
+def seed(users, chunks_per_user):
+    from auth import create_access_token, get_password_hash
+    from database import SessionLocal, User, init_db
+    from rag import process_and_save_pdf_text
+
+    init_db()
+    db = SessionLocal()
+    tokens = []
+    rng = random.Random(0)
+    hashed = get_password_hash("bench")
+    for u in range(users):
+        user = User(username=f"bench{u}", hashed_password=hashed)
+        db.add(user)
+        db.commit()
+        # 400 new characters per 500/100 chunk window
+        text = " ".join(rng.choice(WORDS) for _ in range(chunks_per_user * 50))
+        process_and_save_pdf_text(text, f"bench{u}.pdf", db, user.id)
+        tokens.append(create_access_token({"sub": user.username}))
+    db.close()
+    return tokens
+
+
+def create_app():
+    # uvicorn --factory entry point: the real app plus the blocking baseline route
+    from main import app
+    add_blocking_route(app)
+    return app
+
+
+def add_blocking_route(app):
+    from fastapi import Depends, Form, HTTPException
+    from fastapi.security import OAuth2PasswordBearer
+    from jose import jwt
+    from auth import ALGORITHM, SECRET_KEY
+    from database import SessionLocal, User
+    from rag import generate_answer
+
+    oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+
+    @app.post("/bench/blocking-query")
+    async def blocking_query(question: str = Form(...), token: str = Depends(oauth2_scheme)):
+        db = SessionLocal()
+        try:
+            username = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])["sub"]
+            user = db.query(User).filter(User.username == username).first()
+            if user is None:
+                raise HTTPException(status_code=401)
+            return {"answer": generate_answer(question, db, user.id)}
+        finally:
+            db.close()
+
+
+async def drive(client, path, tokens, concurrency, requests):
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        headers = {"Authorization": f"Bearer {tokens[i % len(tokens)]}"}
+        question = f"{random.choice(WORDS)} {random.choice(WORDS)} #{i}"
+        async with sem:
+            start = time.perf_counter()
+            r = await client.post(path, data={"question": question}, headers=headers)
+            latencies.append(time.perf_counter() - start)
+            r.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    wall = time.perf_counter() - start
+    ms = np.array(latencies) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(ms, 50)), 2),
+        "p95_ms": round(float(np.percentile(ms, 95)), 2),
+        "p99_ms": round(float(np.percentile(ms, 99)), 2),
+        "requests_per_second": round(requests / wall, 1),
+    }
+
+
+def start_server(port):
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "--factory", "benchmarks.load:create_app",
+         "--port", str(port), "--log-level", "warning"],
+        env=env,
+    )
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("uvicorn did not start")
+
+
+async def run(args, tokens, base_url):
+    import httpx
+
+    paths = {"blocking": "/bench/blocking-query", "async": "/query"}
+    results = []
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=300, limits=limits) as client:
+        for mode in args.modes.split(","):
+            # Warm the per-user indexes so both modes measure steady state
+            await drive(client, paths[mode], tokens, 1, len(tokens))
+            result = {"mode": mode, "concurrency": args.concurrency, "requests": args.requests,
+                      **await drive(client, paths[mode], tokens, args.concurrency, args.requests)}
+            results.append(result)
+            print(f"{mode:<10}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+                  f"{result['p99_ms']:>10.2f}{result['requests_per_second']:>10.1f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--chunks", type=int, default=20000, help="Chunks per user")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--modes", default="blocking,async")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    # The app resolves its database and stores relative to the working directory
+    os.chdir(tempfile.mkdtemp(prefix="bench_load_"))
+    print(f"Seeding {args.users} users x {args.chunks} chunks in {os.getcwd()}")
+    tokens = seed(args.users, args.chunks)
+
+    server = start_server(args.port)
+    try:
+        print(f"{'mode':<10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}")
+        results = asyncio.run(run(args, tokens, f"http://127.0.0.1:{args.port}"))
+    finally:
+        server.terminate()
+        server.wait()
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Memory, scan throughput and recall of the quantized indexes against float32 L2.
+
+    python -m benchmarks.quantization --chunks 100000 --rerank 0,100
+
+The float32 rows are written to a throwaway embedding store and memory-mapped,
+as a loaded user index sees them, so re-ranking reads from the mapped segment.
+
+  float32  ExactIndex, the ground truth
+  float16  half-precision codes, 2 bytes per dimension
+  int8     int8 codes with a float32 scale per vector
+  pq       product quantization (PQ_SUBVECTORS bytes per vector), scanned
+           with asymmetric distance tables
+"""
+import argparse
+import json
+import tempfile
+import time
+import numpy as np
+
+from benchmarks.index_recall import recall_at_k, synthetic_embeddings, timed_search
+from embedding_store import EmbeddingStore
+from quantization import create_codec
+from vector_index import ExactIndex, QuantizedIndex
+
+MILLION = 1_000_000
+
+
+def summarize(name, index, n, latencies_ms, recall, **extra):
+    # Memory the index cache accounts for: codes (or float32 rows) and the
+    # chunk id per chunk, plus the fixed-size PQ codebooks
+    fixed = index.codec.nbytes if isinstance(index, QuantizedIndex) else 0
+    per_chunk = (index.nbytes - fixed) / n
+    return {
+        "codec": name,
+        **extra,
+        "bytes_per_chunk": round(per_chunk, 1),
+        "mb_per_million_chunks": round((per_chunk * MILLION + fixed) / 2**20, 1),
+        "recall": round(recall, 4),
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 3),
+        "p99_ms": round(float(np.percentile(latencies_ms, 99)), 3),
+        "qps": round(1000 / float(latencies_ms.mean()), 1),
+        # Chunks scored per second by one query stream
+        "scan_mchunks_per_s": round(n / float(latencies_ms.mean()) / 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--codecs", default="float16,int8,pq")
+    parser.add_argument("--rerank", default="0,100", help="Re-ranked candidates per query, 0 for none")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    data = synthetic_embeddings(args.chunks + args.queries)
+    vectors, queries = data[:args.chunks], data[args.chunks:]
+    store = EmbeddingStore(tempfile.mkdtemp(prefix="bench_quant_"), dim=vectors.shape[1])
+    store.append(1, np.arange(args.chunks, dtype=np.int64), vectors)
+    ids, matrix = store.load(1)
+
+    exact = ExactIndex(ids, matrix)
+    truth, latencies = timed_search(exact, queries, args.k)
+    results = [summarize("float32", exact, args.chunks, latencies, 1.0)]
+
+    for name in args.codecs.split(","):
+        start = time.perf_counter()
+        index = QuantizedIndex(create_codec(name), ids, matrix)
+        build_s = round(time.perf_counter() - start, 2)
+        for rerank in (int(r) for r in args.rerank.split(",")):
+            index.rerank = rerank
+            found, latencies = timed_search(index, queries, args.k)
+            results.append(summarize(name, index, args.chunks, latencies, recall_at_k(truth, found),
+                                     rerank=rerank, build_s=build_s))
+
+    print(f"{args.chunks} chunks, {args.queries} queries, recall@{args.k} against float32 L2")
+    print(f"{'codec':<9}{'rerank':>8}{'MB/1M':>10}{'recall':>10}{'p50 ms':>10}{'p99 ms':>10}{'Mchunk/s':>10}")
+    for r in results:
+        print(f"{r['codec']:<9}{r.get('rerank', '-'):>8}{r['mb_per_million_chunks']:>10.1f}{r['recall']:>10.4f}"
+              f"{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['scan_mchunks_per_s']:>10.1f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""End-to-end benchmark suite: ingest, retrieval and the HTTP endpoints in-process.
+
+    python -m benchmarks.suite --users 8 --chunks 100000 --json report.json
+    python -m benchmarks.suite --users 8 --chunks 100000 --baseline report.json
+
+Runs in a throwaway working directory (database, embedding store, uploads)
+on a synthetic corpus from benchmarks.corpus. The HTTP scenarios go through
+the ASGI test client, so they include routing, auth, form parsing and the
+background job queue, but no sockets (see benchmarks.load for that).
+
+  ingest_text   process_and_save_pdf_text, one call per text document
+  retrieve      rag.retrieve on warm indexes, one question at a time
+  http_upload   POST /upload-pdf of generated PDFs until each job is done
+  http_query    POST /query with questions that miss the query cache
+  http_stream   POST /query/stream, fully consumed
+  http_batch    POST /query/batch with --batch-questions per request
+
+Every scenario reports throughput, p50/p95/p99 latency and the process's
+peak RSS so far. With --baseline, throughput, latency and memory changes
+beyond --threshold are listed and the exit status is 1 if any got worse.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+from benchmarks.corpus import Corpus
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ["ingest_text", "retrieve", "http_upload", "http_query", "http_stream", "http_batch"]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / 2**20 if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def summarize(latencies, wall, units, unit_name):
+    ms = np.array(latencies) * 1000
+    return {
+        "count": len(ms),
+        "seconds": round(wall, 3),
+        f"{unit_name}_per_second": round(units / wall, 1) if wall > 0 else 0.0,
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def create_users(n):
+    from auth import create_access_token, get_password_hash
+    from database import SessionLocal, User
+
+    db = SessionLocal()
+    hashed = get_password_hash("bench")
+    users = []
+    for u in range(n):
+        user = User(username=f"bench{u}", hashed_password=hashed)
+        db.add(user)
+        db.commit()
+        users.append((user.id, create_access_token({"sub": user.username})))
+    db.close()
+    return users
+
+
+def run_ingest_text(corpus, users, args):
+    from database import SessionLocal
+    from rag import process_and_save_pdf_text
+
+    latencies, chunks = [], 0
+    db = SessionLocal()
+    start = time.perf_counter()
+    try:
+        for user, filename, n in corpus.documents(args.chunks, len(users), args.doc_chunks):
+            text = corpus.text(n)
+            t = time.perf_counter()
+            chunks += process_and_save_pdf_text(text, filename, db, users[user][0])
+            latencies.append(time.perf_counter() - t)
+    finally:
+        db.close()
+    # Text generation happens between the timed calls; leave it out of the wall time too
+    return {**summarize(latencies, sum(latencies), chunks, "chunks"), "chunks": chunks,
+            "total_seconds": round(time.perf_counter() - start, 3)}
+
+
+def run_retrieve(corpus, users, args):
+    from database import SessionLocal
+    from rag import retrieve
+
+    db = SessionLocal()
+    try:
+        # First query per user loads their indexes; timed separately
+        cold = []
+        for user_id, _ in users:
+            t = time.perf_counter()
+            retrieve(corpus.question(), db, user_id, args.top_k)
+            cold.append(time.perf_counter() - t)
+        latencies = []
+        start = time.perf_counter()
+        for i in range(args.queries):
+            question = corpus.question()
+            t = time.perf_counter()
+            retrieve(question, db, users[i % len(users)][0], args.top_k)
+            latencies.append(time.perf_counter() - t)
+        wall = time.perf_counter() - start
+    finally:
+        db.close()
+    return {**summarize(latencies, wall, len(latencies), "queries"),
+            "cold_p50_ms": round(float(np.percentile(np.array(cold) * 1000, 50)), 3)}
+
+
+def run_http_upload(client, corpus, users, args):
+    paths = []
+    for i in range(args.pdfs):
+        path = os.path.abspath(f"bench{i:04d}.pdf")
+        corpus.write_pdf(path, args.pdf_chunks)
+        paths.append(path)
+
+    latencies, chunks = [], 0
+    start = time.perf_counter()
+    for i, path in enumerate(paths):
+        headers = _auth(users[i % len(users)])
+        t = time.perf_counter()
+        with open(path, "rb") as f:
+            r = client.post("/upload-pdf", files={"file": (os.path.basename(path), f, "application/pdf")},
+                            headers=headers)
+        r.raise_for_status()
+        while True:
+            job = client.get(f"/jobs/{r.json()['job_id']}", headers=headers).json()
+            if job["state"] not in ("queued", "running"):
+                break
+            time.sleep(0.005)
+        latencies.append(time.perf_counter() - t)
+        if job["state"] != "done":
+            raise RuntimeError(f"Upload of {path} failed: {job['error']}")
+        chunks += job["chunks_done"]
+    wall = time.perf_counter() - start
+    return {**summarize(latencies, wall, chunks, "chunks"), "chunks": chunks}
+
+
+def run_http_query(client, corpus, users, args, path="/query"):
+    latencies, ttft = [], []
+    start = time.perf_counter()
+    for i in range(args.queries):
+        # The counter keeps every question a query cache miss
+        data = {"question": f"{corpus.question()} #{i}", "top_k": args.top_k}
+        t = time.perf_counter()
+        r = client.post(path, data=data, headers=_auth(users[i % len(users)]))
+        latencies.append(time.perf_counter() - t)
+        r.raise_for_status()
+        if path == "/query/stream":
+            done = json.loads(r.text.rsplit("data: ", 1)[1])
+            ttft.append(done["ttft_ms"])
+    wall = time.perf_counter() - start
+    result = summarize(latencies, wall, len(latencies), "queries")
+    if ttft:
+        # Measured by the server; the test client only returns the finished body
+        result["ttft_p50_ms"] = round(float(np.percentile(ttft, 50)), 3)
+        result["ttft_p99_ms"] = round(float(np.percentile(ttft, 99)), 3)
+    return result
+
+
+def run_http_batch(client, corpus, users, args):
+    latencies, questions = [], 0
+    requests = max(1, args.queries // args.batch_questions)
+    start = time.perf_counter()
+    for i in range(requests):
+        batch = [f"{corpus.question()} #{i}.{j}" for j in range(args.batch_questions)]
+        t = time.perf_counter()
+        r = client.post("/query/batch", json={"questions": batch, "top_k": args.top_k},
+                        headers=_auth(users[i % len(users)]))
+        latencies.append(time.perf_counter() - t)
+        r.raise_for_status()
+        questions += len(batch)
+    wall = time.perf_counter() - start
+    return {**summarize(latencies, wall, questions, "questions"), "questions": questions}
+
+
+def _auth(user):
+    return {"Authorization": f"Bearer {user[1]}"}
+
+
+def run(args):
+    from fastapi.testclient import TestClient
+    from database import init_db
+    from main import app
+
+    wanted = args.scenarios.split(",")
+    corpus = Corpus(args.seed)
+    init_db()
+    users = create_users(args.users)
+    results = {}
+
+    def record(name, scenario):
+        if name not in wanted:
+            return
+        results[name] = scenario()
+        r = results[name]
+        throughput = next(v for k, v in r.items() if k.endswith("_per_second"))
+        print(f"{name:<14}{r['count']:>8}{throughput:>14.1f}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}"
+              f"{r['p99_ms']:>10.2f}{r['peak_rss_mb']:>12.1f}")
+
+    print(f"{'scenario':<14}{'count':>8}{'per second':>14}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'peak RSS MB':>12}")
+    record("ingest_text", lambda: run_ingest_text(corpus, users, args))
+    record("retrieve", lambda: run_retrieve(corpus, users, args))
+    with TestClient(app) as client:
+        record("http_upload", lambda: run_http_upload(client, corpus, users, args))
+        record("http_query", lambda: run_http_query(client, corpus, users, args))
+        record("http_stream", lambda: run_http_query(client, corpus, users, args, path="/query/stream"))
+        record("http_batch", lambda: run_http_batch(client, corpus, users, args))
+    return results
+
+
+def environment(args):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    knobs = ["INDEX_BACKEND", "VECTOR_QUANTIZATION", "RETRIEVAL_MODE", "INGEST_BATCH_SIZE"]
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "args": {k: v for k, v in vars(args).items() if k not in ("json", "baseline")},
+        "env": {k: os.environ[k] for k in knobs if k in os.environ},
+    }
+
+
+def compare(report, baseline, threshold):
+    """Rows of (scenario, metric, baseline, current, change) beyond the
+    threshold, and whether any of them is a regression."""
+    rows, regressed = [], False
+    for name, current in report["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if before is None:
+            continue
+        for metric, value in current.items():
+            old = before.get(metric)
+            if not old or not isinstance(value, (int, float)):
+                continue
+            if metric.endswith("_per_second"):
+                worse = value < old
+            elif metric.endswith("_ms") or metric.endswith("_mb"):
+                worse = value > old
+            else:
+                continue
+            change = (value - old) / old
+            if abs(change) >= threshold:
+                rows.append((name, metric, old, value, change, worse))
+                regressed = regressed or worse
+    return rows, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--chunks", type=int, default=10000, help="Text chunks ingested in total, across all users")
+    parser.add_argument("--doc-chunks", type=int, default=100, help="Chunks per text document")
+    parser.add_argument("--pdfs", type=int, default=4)
+    parser.add_argument("--pdf-chunks", type=int, default=200, help="Chunks per uploaded PDF")
+    parser.add_argument("--queries", type=int, default=200, help="Questions per query scenario")
+    parser.add_argument("--batch-questions", type=int, default=50, help="Questions per /query/batch request")
+    parser.add_argument("--top-k", type=int, default=2)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Write the report to this file (e.g. to keep as a baseline)")
+    parser.add_argument("--baseline", help="Compare against a report written by --json")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change worth reporting")
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json) if args.json else None
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    # The app resolves its database and stores relative to the working directory
+    os.chdir(tempfile.mkdtemp(prefix="bench_suite_"))
+    print(f"{args.users} users, {args.chunks} text chunks, {args.pdfs} PDFs in {os.getcwd()}")
+    report = {"environment": environment(args), "results": run(args)}
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if baseline is not None:
+        rows, regressed = compare(report, baseline, args.threshold)
+        print(f"\nAgainst {args.baseline} (commit {baseline.get('environment', {}).get('commit')}), "
+              f"changes of {args.threshold:.0%} or more:")
+        for name, metric, old, value, change, worse in rows:
+            print(f"{name:<14}{metric:<22}{old:>12}{value:>12}{change:>+9.1%}  {'worse' if worse else 'better'}")
+        if not rows:
+            print("none")
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
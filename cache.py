@@ -0,0 +1,92 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe least-recently-used mapping with hit/miss counters.
+
+    With ``ttl`` (seconds) entries also expire; ``put`` can shorten the
+    lifetime of a single entry. With ``max_bytes`` the total ``sizeof``
+    of the values is capped as well.
+    """
+
+    def __init__(self, max_items, ttl=None, max_bytes=None, sizeof=None):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda key, value: 0)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at, _ = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def put(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl or ttl)
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        size = self.sizeof(key, value)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expires_at, size)
+            self.bytes += size
+            while len(self._data) > self.max_items or (
+                    self.max_bytes is not None and self.bytes > self.max_bytes and self._data):
+                self._remove(next(iter(self._data)))
+
+    def _remove(self, key):
+        self.bytes -= self._data.pop(key)[2]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value = self._data[key][0]
+            self._remove(key)
+            return value
+
+    def values(self):
+        # Snapshot, expired entries included
+        with self._lock:
+            return [value for value, _, _ in self._data.values()]
+
+    def remove_where(self, predicate):
+        # Drops every entry for which predicate(key, value) is true
+        with self._lock:
+            stale = [key for key, (value, _, _) in self._data.items() if predicate(key, value)]
+            for key in stale:
+                self._remove(key)
+            return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_items": self.max_items,
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
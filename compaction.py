@@ -0,0 +1,346 @@
+"""Document deletion and background compaction.
+
+Deleting a document only tombstones the chunks no other live file still
+references: the rows stay in the embedding store and the database, and the
+indexes mask them out at query time. Compaction later removes them for good,
+rewrites the user's embedding segment and hands free pages back to SQLite.
+
+    python compaction.py     # compact every user now and print the report
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+try:
+    import fcntl
+except ImportError:  # Windows: every worker compacts
+    fcntl = None
+
+from database import (SessionLocal, WriteSessionLocal, write_engine, USE_SQLITE, init_db,
+                      bump_index_version, bump_index_version_async, user_chunk_ids,
+                      ChunkTombstone, DocumentChunk, FileChunk, IngestJob, UploadedFile)
+from embedding_store import embedding_store
+from lexical_index import lexical_indexes
+from query_cache import query_cache
+from vector_index import user_indexes
+
+# How often the background compactor looks for work
+COMPACT_INTERVAL_SECONDS = int(os.getenv("COMPACT_INTERVAL_SECONDS", "300"))
+# A user is compacted once this share of their stored rows, or this many
+# rows, are tombstoned
+COMPACT_DEAD_RATIO = float(os.getenv("COMPACT_DEAD_RATIO", "0.1"))
+COMPACT_DEAD_ROWS = int(os.getenv("COMPACT_DEAD_ROWS", "10000"))
+
+# Ids per DELETE / INSERT statement
+ID_BATCH = 500
+
+
+class DocumentBusy(Exception):
+    pass
+
+
+async def delete_document_async(db: AsyncSession, user_id: int, file_id: int):
+    """Mark a file deleted and tombstone the chunks only it referenced.
+
+    The work is proportional to the file's own chunks, never to the rest of
+    the corpus. Returns the number of chunks tombstoned, or None if the user
+    has no such file.
+    """
+    result = await db.execute(select(UploadedFile).where(
+        UploadedFile.id == file_id, UploadedFile.user_id == user_id, UploadedFile.deleted_at.is_(None)))
+    file = result.scalars().first()
+    if file is None:
+        return None
+    result = await db.execute(select(IngestJob.id).where(
+        IngestJob.file_id == file_id, IngestJob.state.in_(["queued", "running"])))
+    if result.first() is not None:
+        raise DocumentBusy()
+
+    dead = await db.run_sync(lambda session: _tombstone_file(session, user_id, file))
+    version = await bump_index_version_async(db, user_id)
+    await db.commit()
+    _drop_from_indexes(user_id, dead, version)
+    return len(dead)
+
+
+def delete_partial_upload(db, user_id: int, file_id: int):
+    """Tombstone what a failed ingest job committed before it failed.
+
+    Its job is still running, so this skips the busy check of a user
+    deletion. Returns the number of chunks tombstoned.
+    """
+    file = db.query(UploadedFile).filter(
+        UploadedFile.id == file_id, UploadedFile.user_id == user_id, UploadedFile.deleted_at.is_(None)).first()
+    if file is None:
+        return 0
+    dead = _tombstone_file(db, user_id, file)
+    version = bump_index_version(db, user_id)
+    db.commit()
+    _drop_from_indexes(user_id, dead, version)
+    return len(dead)
+
+
+def _tombstone_file(db, user_id, file):
+    # Sync session: the async path runs this through run_sync
+    file.deleted_at = datetime.utcnow()
+    db.flush()
+
+    # Chunks of this file that no live file of the user references any more
+    other = aliased(FileChunk)
+    live_elsewhere = (
+        select(other.chunk_id)
+        .join(UploadedFile, UploadedFile.id == other.file_id)
+        .where(other.chunk_id == FileChunk.chunk_id, UploadedFile.user_id == user_id,
+               UploadedFile.deleted_at.is_(None))
+        .exists()
+    )
+    dead = db.execute(
+        select(FileChunk.chunk_id).where(FileChunk.file_id == file.id, ~live_elsewhere).distinct()).scalars().all()
+    for start in range(0, len(dead), ID_BATCH):
+        db.execute(insert(ChunkTombstone), [
+            {"user_id": user_id, "chunk_id": chunk_id} for chunk_id in dead[start:start + ID_BATCH]
+        ])
+
+    # Shared chunks that were shown as coming from this file now name a
+    # remaining one (dead chunks get NULL, they are purged anyway)
+    first_live = (
+        select(func.min(other.file_id))
+        .join(UploadedFile, UploadedFile.id == other.file_id)
+        .where(other.chunk_id == DocumentChunk.id, UploadedFile.deleted_at.is_(None))
+        .scalar_subquery()
+    )
+    db.execute(
+        update(DocumentChunk)
+        .where(DocumentChunk.id.in_(select(FileChunk.chunk_id).where(FileChunk.file_id == file.id)),
+               DocumentChunk.file_id == file.id)
+        .values(file_id=first_live)
+        .execution_options(synchronize_session=False)
+    )
+    return dead
+
+
+def _drop_from_indexes(user_id, dead, version):
+    user_indexes.delete(user_id, dead)
+    lexical_indexes.delete(user_id, dead)
+    user_indexes.advance(user_id, version)
+    lexical_indexes.advance(user_id, version)
+    query_cache.invalidate(user_id)
+
+
+def compact_user(user_id: int):
+    """Purge a user's tombstoned chunks and deleted files, then rewrite their segment."""
+    start = time.perf_counter()
+    db = WriteSessionLocal()
+    try:
+        # Database first: once the tombstones are gone an upload can no
+        # longer revive these chunks, so dropping their vectors is safe
+        purged = db.execute(
+            delete(ChunkTombstone).where(ChunkTombstone.user_id == user_id).returning(ChunkTombstone.chunk_id)
+        ).scalars().all()
+        deleted_files = select(UploadedFile.id).where(
+            UploadedFile.user_id == user_id, UploadedFile.deleted_at.isnot(None)).scalar_subquery()
+        db.execute(delete(FileChunk).where(FileChunk.file_id.in_(deleted_files)))
+        for batch_start in range(0, len(purged), ID_BATCH):
+            db.execute(delete(DocumentChunk).where(DocumentChunk.id.in_(purged[batch_start:batch_start + ID_BATCH])))
+        # Finished jobs keep their history, without the file
+        db.execute(update(IngestJob).where(IngestJob.file_id.in_(deleted_files)).values(file_id=None))
+        files = db.execute(delete(UploadedFile).where(
+            UploadedFile.user_id == user_id, UploadedFile.deleted_at.isnot(None))).rowcount
+        # Other worker processes drop their indexes of the old segment: with
+        # the tombstones gone, catching up would unmask the purged rows
+        bump_index_version(db, user_id, generation=True)
+        db.commit()
+    finally:
+        db.close()
+
+    rows_before, rows_after = embedding_store.compact(user_id, lambda: user_chunk_ids(user_id))
+    if rows_after < rows_before:
+        # A worker that reloaded between the commit above and the rewrite
+        # mapped the old segment without the tombstones, at the current
+        # generation; bump again so it reloads the new segment (row
+        # positions changed, so it cannot catch up either)
+        db = WriteSessionLocal()
+        try:
+            bump_index_version(db, user_id, generation=True)
+            db.commit()
+        finally:
+            db.close()
+    # The cached indexes still map the old segment; the next query loads the new one
+    user_indexes.invalidate(user_id)
+    lexical_indexes.invalidate(user_id)
+    elapsed = time.perf_counter() - start
+    return {
+        "user_id": user_id,
+        "chunks_purged": len(purged),
+        "files_purged": files,
+        "rows_before": rows_before,
+        "rows_after": rows_after,
+        "bytes_reclaimed": (rows_before - rows_after) * (4 * embedding_store.dim + 8),
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(rows_before / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+
+
+def _page_stats(conn):
+    return {pragma: conn.exec_driver_sql(f"PRAGMA {pragma}").scalar()
+            for pragma in ("page_size", "page_count", "freelist_count")}
+
+
+def reclaim_space():
+    """Return SQLite's free pages to the filesystem. Returns pages before/after."""
+    if not USE_SQLITE:
+        # PostgreSQL's autovacuum reclaims dead tuples on its own
+        return None
+    start = time.perf_counter()
+    with write_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        before = _page_stats(conn)
+        if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+            # Databases created before incremental mode need one full VACUUM to switch
+            conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.exec_driver_sql("VACUUM")
+        else:
+            # sqlite3's execute() steps this pragma once and frees a single
+            # page; executescript() runs it to completion
+            conn.connection.driver_connection.executescript("PRAGMA incremental_vacuum")
+        after = _page_stats(conn)
+    return {
+        "pages_before": before["page_count"],
+        "pages_after": after["page_count"],
+        "bytes_reclaimed": (before["page_count"] - after["page_count"]) * before["page_size"],
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def _user_fragmentation(user_id, dead, deleted_files):
+    rows = embedding_store.count(user_id)
+    return {
+        "user_id": user_id,
+        "rows": rows,
+        "dead_rows": dead,
+        "dead_ratio": round(dead / rows, 4) if rows else 0.0,
+        "deleted_files": deleted_files,
+    }
+
+
+def user_fragmentation(user_id: int):
+    """The fragmentation() entry of one user, read through their own rows only."""
+    db = SessionLocal()
+    try:
+        dead = db.query(func.count()).select_from(ChunkTombstone).filter(ChunkTombstone.user_id == user_id).scalar()
+        deleted_files = (db.query(func.count()).select_from(UploadedFile)
+                         .filter(UploadedFile.user_id == user_id, UploadedFile.deleted_at.isnot(None)).scalar())
+    finally:
+        db.close()
+    return _user_fragmentation(user_id, dead, deleted_files)
+
+
+def fragmentation():
+    """Tombstoned rows per user and free pages in the database file."""
+    db = SessionLocal()
+    try:
+        dead = dict(db.query(ChunkTombstone.user_id, func.count()).group_by(ChunkTombstone.user_id).all())
+        deleted_files = dict(
+            db.query(UploadedFile.user_id, func.count())
+            .filter(UploadedFile.deleted_at.isnot(None))
+            .group_by(UploadedFile.user_id)
+            .all()
+        )
+        pages = _page_stats(db.connection()) if USE_SQLITE else None
+    finally:
+        db.close()
+    users = [_user_fragmentation(user_id, dead.get(user_id, 0), deleted_files.get(user_id, 0))
+             for user_id in sorted(set(dead) | set(deleted_files))]
+    report = {"dead_rows": sum(dead.values()), "users": users}
+    if pages is not None:
+        report["db_free_pages"] = pages["freelist_count"]
+        report["db_free_ratio"] = round(pages["freelist_count"] / pages["page_count"], 4) if pages["page_count"] else 0.0
+    return report
+
+
+def _due(user):
+    if user["dead_rows"] == 0:
+        # Only file rows to drop, no segment rewrite
+        return user["deleted_files"] > 0
+    return user["dead_rows"] >= COMPACT_DEAD_ROWS or user["dead_ratio"] >= COMPACT_DEAD_RATIO
+
+
+def compact_all(force=False):
+    start = time.perf_counter()
+    before = fragmentation()
+    users = [compact_user(u["user_id"]) for u in before["users"] if force or _due(u)]
+    vacuum = reclaim_space() if users else None
+    elapsed = time.perf_counter() - start
+    rows = sum(u["rows_before"] for u in users)
+    return {
+        "finished_at": datetime.utcnow().isoformat(),
+        "fragmentation_before": before,
+        "users": users,
+        "vacuum": vacuum,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(rows / elapsed, 1) if users and elapsed > 0 else 0.0,
+        "bytes_reclaimed": sum(u["bytes_reclaimed"] for u in users) + (vacuum["bytes_reclaimed"] if vacuum else 0),
+    }
+
+
+@contextmanager
+def _exclusive(path):
+    # Yields whether this process holds the lock; with several uvicorn
+    # workers only one compacts per round, the others skip it
+    if fcntl is None:
+        yield True
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class Compactor:
+    """Background thread compacting users whose tombstones pass the thresholds."""
+
+    def __init__(self, interval=COMPACT_INTERVAL_SECONDS):
+        self.interval = interval
+        self.last_run = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="compactor", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=30):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                with _exclusive(os.path.join(embedding_store.root, "compaction.lock")) as acquired:
+                    if acquired:
+                        self.last_run = compact_all()
+            except Exception as e:
+                print(f"Compaction failed: {e}")
+
+
+compactor = Compactor()
+
+
+if __name__ == "__main__":
+    init_db()
+    print(json.dumps(compact_all(force=True), indent=2))
@@ -0,0 +1,45 @@
+import itertools
+import os
+import shutil
+import tempfile
+
+import pytest
+
+# Clear of the fixed user ids test_tenant_isolation.py writes to
+_user_ids = itertools.count(1000)
+_cwd = os.getcwd()
+_workdir = None
+
+
+def pytest_configure(config):
+    # The app keeps its database and embedding store relative to the working
+    # directory, and the database path is fixed once database.py is imported:
+    # move to a scratch directory before any test module imports it
+    global _workdir
+    _workdir = tempfile.mkdtemp(prefix="rag-tests-")
+    os.chdir(_workdir)
+
+
+def pytest_unconfigure(config):
+    os.chdir(_cwd)
+    shutil.rmtree(_workdir, ignore_errors=True)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    from database import init_db
+    init_db()
+
+
+@pytest.fixture
+def user_id():
+    from database import SessionLocal, User
+    db = SessionLocal()
+    try:
+        new_id = next(_user_ids)
+        user = User(id=new_id, username=f"user-{new_id}", hashed_password="x")
+        db.add(user)
+        db.commit()
+        return new_id
+    finally:
+        db.close()
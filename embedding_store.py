@@ -0,0 +1,178 @@
+import os
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: only in-process locking
+    fcntl = None
+
+# Width of a stored embedding row, must match the embedder in rag.py
+EMBED_DIM = 384
+
+# Directory holding one append-only segment per user:
+#   user_<id>.f32  raw float32 rows of EMBED_DIM values
+#   user_<id>.ids  int64 chunk id of each row (the row-id sidecar)
+EMBED_STORE_DIR = os.getenv("EMBED_STORE_DIR", "./embeddings")
+
+# Rows copied per write while compacting a segment
+COMPACT_BLOCK_ROWS = 65536
+
+
+class EmbeddingStore:
+    def __init__(self, root=EMBED_STORE_DIR, dim=EMBED_DIM):
+        self.root = root
+        self.dim = dim
+        # One lock per user: compacting a segment must not stall the others
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _path(self, user_id, ext):
+        return os.path.join(self.root, f"user_{user_id}.{ext}")
+
+    @contextmanager
+    def _locked(self, user_id):
+        # Serialise appends within the process and, where supported, across
+        # uvicorn workers writing the same user's segment.
+        with self._locks_lock:
+            lock = self._locks.setdefault(user_id, threading.Lock())
+        with lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self._path(user_id, "lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _rows(self, user_id):
+        # Rows fully present in both files; a crash mid-append leaves a tail
+        # in one of them which is ignored here and truncated on the next append.
+        try:
+            vec_bytes = os.path.getsize(self._path(user_id, "f32"))
+            id_bytes = os.path.getsize(self._path(user_id, "ids"))
+        except FileNotFoundError:
+            return 0
+        return min(vec_bytes // (4 * self.dim), id_bytes // 8)
+
+    def count(self, user_id):
+        return self._rows(user_id)
+
+    def nbytes(self, user_id):
+        return self._rows(user_id) * (4 * self.dim + 8)
+
+    def _recover(self, user_id):
+        # Compaction writes both .new files, then renames f32 before ids.
+        # A leftover f32.new means nothing was swapped yet: drop the attempt.
+        # A lone ids.new means the crash came between the renames: finish.
+        new_vectors, new_ids = self._path(user_id, "f32.new"), self._path(user_id, "ids.new")
+        if os.path.exists(new_vectors):
+            os.remove(new_vectors)
+            if os.path.exists(new_ids):
+                os.remove(new_ids)
+        elif os.path.exists(new_ids):
+            os.replace(new_ids, self._path(user_id, "ids"))
+
+    def append(self, user_id, ids, vectors, commit=None):
+        """Append rows to a user's segment.
+
+        ``commit`` (the database commit that created the chunk ids) runs
+        under the segment lock before anything is written: if it fails no
+        row is left behind whose id the database may hand out again, and
+        a reader that saw the commit waits for the rows before loading.
+        """
+        ids = np.ascontiguousarray(ids, dtype=np.int64)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(ids), self.dim)
+        if len(ids) == 0:
+            if commit is not None:
+                commit()
+            return
+        os.makedirs(self.root, exist_ok=True)
+        with self._locked(user_id):
+            if commit is not None:
+                commit()
+            self._recover(user_id)
+            rows = self._rows(user_id)
+            # Vectors first, then ids: a row only counts once its id is written
+            for ext, data, row_bytes in (("f32", vectors, 4 * self.dim), ("ids", ids, 8)):
+                with open(self._path(user_id, ext), "ab") as f:
+                    f.truncate(rows * row_bytes)
+                    f.write(data.tobytes())
+
+    def load(self, user_id):
+        """Map a user's segment read-only; returns (ids, matrix) without copying."""
+        if os.path.isdir(self.root):
+            with self._locked(user_id):
+                self._recover(user_id)
+        return self._load(user_id)
+
+    def load_since(self, user_id, start):
+        """Map the rows appended from row ``start`` on; returns (ids, matrix,
+        rows), ``rows`` being the segment's row count. Like load(), waits for
+        an append whose commit is already visible."""
+        empty = np.empty(0, dtype=np.int64), np.empty((0, self.dim), dtype=np.float32)
+        if not os.path.isdir(self.root):
+            return (*empty, 0)
+        with self._locked(user_id):
+            self._recover(user_id)
+            rows = self._rows(user_id)
+        if rows <= start:
+            return (*empty, rows)
+        ids = np.memmap(self._path(user_id, "ids"), dtype=np.int64, mode="r", shape=(rows,))
+        matrix = np.memmap(self._path(user_id, "f32"), dtype=np.float32, mode="r", shape=(rows, self.dim))
+        return ids[start:], matrix[start:], rows
+
+    def _load(self, user_id):
+        rows = self._rows(user_id)
+        if rows == 0:
+            return np.empty(0, dtype=np.int64), np.empty((0, self.dim), dtype=np.float32)
+        ids = np.memmap(self._path(user_id, "ids"), dtype=np.int64, mode="r", shape=(rows,))
+        matrix = np.memmap(self._path(user_id, "f32"), dtype=np.float32, mode="r", shape=(rows, self.dim))
+        if rows > 1 and not (np.diff(ids) > 0).all():
+            # Segments written before appends waited for the commit can hold
+            # rows of rolled-back transactions (e.g. an interrupted ingest
+            # job) whose ids the database handed out again; the last row wins.
+            _, last = np.unique(ids[::-1], return_index=True)
+            if len(last) < rows:
+                keep = np.sort(rows - 1 - last)
+                return np.asarray(ids[keep]), np.asarray(matrix[keep])
+        return ids, matrix
+
+    def compact(self, user_id, live_ids):
+        """Rewrite a user's segment keeping only the rows of chunks that
+        still exist. Rows are read through _load(), so of an id appended
+        more than once only the last row is kept.
+
+        ``live_ids()`` returns the user's chunk ids in the database. It is
+        called under the segment lock, where the commit of every appended
+        row is visible, so purged chunks and rows left by rolled-back
+        batches are dropped, never rows of a concurrent upload.
+
+        Readers that mapped the old files keep using them; the new files are
+        swapped in by rename. Returns (rows_before, rows_after).
+        """
+        with self._locked(user_id):
+            self._recover(user_id)
+            rows = self._rows(user_id)
+            # Deduplicated: `rows` counts every row, `ids` one per chunk
+            ids, matrix = self._load(user_id)
+            keep = np.flatnonzero(np.isin(ids, np.asarray(live_ids(), dtype=np.int64)))
+            if len(keep) == rows:
+                return rows, rows
+
+            new_vectors, new_ids = self._path(user_id, "f32.new"), self._path(user_id, "ids.new")
+            for path, data in ((new_vectors, matrix), (new_ids, ids)):
+                with open(path, "wb") as f:
+                    for start in range(0, len(keep), COMPACT_BLOCK_ROWS):
+                        f.write(np.ascontiguousarray(data[keep[start:start + COMPACT_BLOCK_ROWS]]).tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(new_vectors, self._path(user_id, "f32"))
+            os.replace(new_ids, self._path(user_id, "ids"))
+            return rows, len(keep)
+
+
+embedding_store = EmbeddingStore()
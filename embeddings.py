@@ -0,0 +1,172 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import List, Protocol
+import numpy as np
+
+from cache import LRUCache
+from embedding_store import EMBED_DIM
+
+# Local sentence-transformers model used when rag.USE_MOCK is off.
+# all-MiniLM-L6-v2 produces EMBED_DIM (384) wide vectors.
+EMBED_MODEL = os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+
+# Content-hash keyed cache: in-memory LRU, plus an optional SQLite file that
+# survives restarts and is shared by every worker pointing at it.
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "20000"))
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH")
+
+
+class Embedder(Protocol):
+    name: str
+    dim: int
+
+    def embed_batch(self, texts: List[str]) -> np.ndarray:
+        """Embed ``texts`` into a float32 array of shape (len(texts), dim)."""
+        ...
+
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+
+
+def _splitmix64(x):
+    x = (x ^ (x >> np.uint64(30))) * _MIX1
+    x = (x ^ (x >> np.uint64(27))) * _MIX2
+    return x ^ (x >> np.uint64(31))
+
+
+def text_seed(text):
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class MockEmbedder:
+    """Deterministic pseudo-random unit-normal vectors keyed on the text.
+
+    Unlike seeding the global NumPy RNG, this keeps no shared state (safe
+    under concurrent uploads), is stable across processes, and embeds a
+    whole batch with a handful of array operations.
+    """
+
+    name = "mock"
+
+    def __init__(self, dim=EMBED_DIM):
+        self.dim = dim
+        self._counters = (np.arange(dim + dim % 2, dtype=np.uint64) + np.uint64(1)) * _GOLDEN
+
+    def embed_batch(self, texts: List[str]) -> np.ndarray:
+        seeds = np.fromiter((text_seed(t) for t in texts), dtype=np.uint64, count=len(texts))
+        with np.errstate(over="ignore"):
+            bits = _splitmix64(seeds[:, None] + self._counters[None, :])
+        # 53-bit uniforms in (0, 1], paired up through Box-Muller
+        u = ((bits >> np.uint64(11)).astype(np.float64) + 1.0) * (1.0 / 2**53)
+        u1, u2 = u[:, 0::2], u[:, 1::2]
+        r = np.sqrt(-2.0 * np.log(u1))
+        theta = 2.0 * np.pi * u2
+        out = np.empty((len(texts), u.shape[1]), dtype=np.float32)
+        out[:, 0::2] = r * np.cos(theta)
+        out[:, 1::2] = r * np.sin(theta)
+        return out[:, :self.dim]
+
+
+class SentenceTransformerEmbedder:
+    def __init__(self, model_name=EMBED_MODEL, batch_size=EMBED_BATCH_SIZE):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise RuntimeError("Install 'sentence-transformers' to use a local embedding model.") from e
+        self.name = model_name
+        self.batch_size = batch_size
+        self.model = SentenceTransformer(model_name)
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed_batch(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.empty((0, self.dim), dtype=np.float32)
+        vectors = self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True)
+        return vectors.astype(np.float32, copy=False)
+
+
+class DiskEmbeddingCache:
+    def __init__(self, path, dim):
+        self.dim = dim
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL)")
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[bytes(key)] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, items):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, vec.tobytes()) for key, vec in items],
+            )
+
+
+class CachedEmbedder:
+    """Wraps an embedder so repeated texts (re-uploaded chunks, repeated
+    questions) are served from a content-hash cache instead of re-embedded."""
+
+    def __init__(self, embedder: Embedder, cache_size=EMBED_CACHE_SIZE, cache_path=EMBED_CACHE_PATH):
+        self.embedder = embedder
+        self.name = embedder.name
+        self.dim = embedder.dim
+        self.cache = LRUCache(cache_size)
+        self.disk = DiskEmbeddingCache(cache_path, self.dim) if cache_path else None
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.name}\0{text}".encode("utf-8")).digest()
+
+    def embed_batch(self, texts: List[str]) -> np.ndarray:
+        out = np.empty((len(texts), self.dim), dtype=np.float32)
+        keys = [self._key(t) for t in texts]
+
+        missing = {}
+        for i, key in enumerate(keys):
+            vec = self.cache.get(key)
+            if vec is None:
+                missing.setdefault(key, []).append(i)
+            else:
+                out[i] = vec
+
+        if missing and self.disk is not None:
+            for key, vec in self.disk.get_many(list(missing)).items():
+                out[missing[key]] = vec
+                self.cache.put(key, vec)
+                del missing[key]
+
+        if missing:
+            # Each distinct text is embedded once, even if it repeats in the batch
+            keys_to_embed = list(missing)
+            vectors = self.embedder.embed_batch([texts[missing[k][0]] for k in keys_to_embed])
+            for key, vec in zip(keys_to_embed, vectors):
+                out[missing[key]] = vec
+                self.cache.put(key, vec.copy())
+            if self.disk is not None:
+                self.disk.put_many(zip(keys_to_embed, vectors))
+        return out
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def create_embedder(use_mock=True) -> CachedEmbedder:
+    base = MockEmbedder() if use_mock else SentenceTransformerEmbedder()
+    return CachedEmbedder(base)
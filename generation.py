@@ -0,0 +1,48 @@
+import os
+import re
+import time
+from typing import Iterator, List, Protocol
+
+# Simulated per-token latency of the mock generator, to exercise streaming locally
+MOCK_TOKEN_DELAY_MS = float(os.getenv("MOCK_TOKEN_DELAY_MS", "0"))
+
+NO_DOCUMENTS = "No documents found in your history. Please upload a PDF."
+
+# A word and the whitespace after it, so the pieces join back to the exact text
+_TOKEN = re.compile(r"\S*\s*")
+
+
+class AnswerGenerator(Protocol):
+    name: str
+
+    def generate(self, question: str, docs: List[str]) -> Iterator[str]:
+        """Yield the answer to ``question`` from ``docs`` piece by piece, as produced."""
+        ...
+
+
+class MockGenerator:
+    """Echoes the retrieved chunks word by word, standing in for an LLM."""
+
+    name = "mock"
+
+    def __init__(self, prefix="Answer based on your history: ", token_delay_ms=MOCK_TOKEN_DELAY_MS):
+        self.prefix = prefix
+        self.token_delay = token_delay_ms / 1000.0
+
+    def generate(self, question: str, docs: List[str]) -> Iterator[str]:
+        if not docs:
+            yield NO_DOCUMENTS
+            return
+        for token in _TOKEN.findall(self.prefix + ", ".join(docs)):
+            if not token:
+                continue
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            yield token
+
+
+def create_generator(use_mock=True) -> AnswerGenerator:
+    if use_mock:
+        return MockGenerator()
+    # No LLM client is wired in yet; keep the placeholder answer format
+    return MockGenerator(prefix="(LLM) Answer based on: ")
@@ -0,0 +1,169 @@
+"""Keeping the per-process index caches of several workers in step, and
+warming them at startup.
+
+Every upload, deletion and compaction bumps the user's row in
+index_versions in the same transaction. Each cached index remembers the
+version it reflects; every INDEX_SYNC_INTERVAL_SECONDS a worker reads the
+versions of the users it holds and catches the entries that changed up in
+place: segment rows appended since, postings for those chunks and the
+current tombstones. So a change made through one worker reaches queries on
+all of them within about that interval, and an upload in progress never
+makes the others rebuild. Only compaction, which rewrites the segment,
+bumps the generation as well, and those entries are dropped and loaded
+again. The worker that made a change applied it in place already and
+skips it. The same poll drops cached bearer tokens of users another
+worker deleted or changed (see auth.sync_token_cache).
+
+Workers also record when they last queried each user in a snapshot file
+shared by all of them. On startup the INDEX_WARM_USERS most recently used
+users ("all": every user with documents) are loaded in the background.
+"""
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: last writer wins
+    fcntl = None
+
+from auth import sync_token_cache
+from database import SessionLocal, IndexVersion, index_versions
+from embedding_store import EMBED_STORE_DIR
+from lexical_index import lexical_indexes
+from query_cache import query_cache
+from rag import RETRIEVAL_MODE
+from vector_index import user_indexes
+
+# Upper bound on how long other workers may serve an index older than a commit (0: off)
+INDEX_SYNC_INTERVAL_SECONDS = float(os.getenv("INDEX_SYNC_INTERVAL_SECONDS", "1"))
+# Users whose indexes are loaded at startup: a count, or "all"
+INDEX_WARM_USERS = os.getenv("INDEX_WARM_USERS", "0")
+INDEX_SNAPSHOT_PATH = os.getenv("INDEX_SNAPSHOT_PATH", os.path.join(EMBED_STORE_DIR, "warm_users.json"))
+INDEX_SNAPSHOT_SECONDS = 60
+# Users remembered by the snapshot, most recent first
+SNAPSHOT_MAX_USERS = 10000
+
+
+def sync_once():
+    """Refresh cached indexes whose user changed in another process; returns their ids."""
+    users = set(user_indexes.users()) | set(lexical_indexes.users())
+    if not users:
+        return []
+    versions = index_versions(users)
+    changed = set(user_indexes.refresh(versions)) | set(lexical_indexes.refresh(versions))
+    for user_id in changed:
+        # Frees answers of the old version; they can no longer be hit anyway
+        query_cache.invalidate(user_id)
+    return sorted(changed)
+
+
+def load_snapshot(path=INDEX_SNAPSHOT_PATH):
+    # {user_id: last query time}
+    try:
+        with open(path) as f:
+            return {int(user_id): used for user_id, used in json.load(f)["last_used"].items()}
+    except (FileNotFoundError, ValueError, KeyError):
+        return {}
+
+
+def save_snapshot(last_used, path=INDEX_SNAPSHOT_PATH):
+    # Merged with what the other workers saved: the latest use per user wins
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".lock", "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        merged = load_snapshot(path)
+        for user_id, used in last_used.items():
+            merged[user_id] = max(used, merged.get(user_id, 0))
+        recent = sorted(merged.items(), key=lambda item: item[1], reverse=True)[:SNAPSHOT_MAX_USERS]
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"last_used": {str(user_id): used for user_id, used in recent}}, f)
+        os.replace(tmp, path)
+
+
+def warm_candidates(count=INDEX_WARM_USERS):
+    snapshot = load_snapshot()
+    recent = sorted(snapshot, key=snapshot.get, reverse=True)
+    if count != "all":
+        return recent[:int(count)]
+    db = SessionLocal()
+    try:
+        users = [user_id for (user_id,) in db.query(IndexVersion.user_id).filter(IndexVersion.version > 0)]
+    finally:
+        db.close()
+    # Recently used first, so they are the ones loaded if memory runs out
+    with_documents, seen = set(users), set(recent)
+    return [u for u in recent if u in with_documents] + [u for u in users if u not in seen]
+
+
+def warm(user_ids, stop=None):
+    """Load indexes until the memory budget is reached. Returns the users loaded."""
+    loaded = []
+    for user_id in user_ids:
+        if (stop is not None and stop.is_set()) or user_indexes.memory_usage() >= user_indexes.budget_bytes:
+            break
+        # Not a query: the snapshot keeps the user's real last use
+        user_indexes.get(user_id, touch=False)
+        if RETRIEVAL_MODE == "hybrid":
+            lexical_indexes.get(user_id, touch=False)
+        loaded.append(user_id)
+    return loaded
+
+
+class IndexSync:
+    """Background thread: warm start, then version polling and snapshots."""
+
+    def __init__(self, interval=INDEX_SYNC_INTERVAL_SECONDS, warm_users=INDEX_WARM_USERS):
+        self.interval = interval
+        self.warm_users = warm_users
+        self.warmed = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="index-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=30):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self._save()
+
+    def _save(self):
+        try:
+            save_snapshot(dict(user_indexes.last_used))
+        except OSError as e:
+            print(f"Saving the index snapshot failed: {e}")
+
+    def _run(self):
+        if self.warm_users not in ("0", "", 0):
+            start = time.perf_counter()
+            try:
+                users = warm(warm_candidates(self.warm_users), self._stop)
+                self.warmed = {"users": len(users), "seconds": round(time.perf_counter() - start, 3)}
+                print(f"Warmed indexes of {len(users)} users in {self.warmed['seconds']}s")
+            except Exception as e:
+                print(f"Index warm-up failed: {e}")
+        saved_at = time.monotonic()
+        while not self._stop.wait(self.interval if self.interval > 0 else INDEX_SNAPSHOT_SECONDS):
+            if self.interval > 0:
+                try:
+                    sync_once()
+                except Exception as e:
+                    print(f"Index sync failed: {e}")
+                try:
+                    sync_token_cache()
+                except Exception as e:
+                    print(f"Auth cache sync failed: {e}")
+            if time.monotonic() - saved_at >= INDEX_SNAPSHOT_SECONDS:
+                self._save()
+                saved_at = time.monotonic()
+
+
+index_sync = IndexSync()
@@ -0,0 +1,253 @@
+import asyncio
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import func, or_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from compaction import delete_partial_upload
+from database import SessionLocal, WriteSessionLocal, IngestJob
+from pdf_extract import iter_pages, count_pages
+from rag import ingest_pages, EmptyDocument
+
+# Number of uploads ingested at the same time by this process
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "2"))
+# Uploads are kept here until their job finishes, so jobs survive a restart
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "./uploads")
+# A running job whose worker has not checked in for this long is considered
+# abandoned (crash or restart) and is picked up again
+JOB_HEARTBEAT_SECONDS = 10
+JOB_STALE_SECONDS = 60
+JOB_POLL_SECONDS = 5
+
+
+class JobInterrupted(Exception):
+    pass
+
+
+async def enqueue_job(db: AsyncSession, user_id: int, filename: str, path: str):
+    pages_total = await asyncio.to_thread(count_pages, path)
+    job = IngestJob(
+        user_id=user_id,
+        filename=filename,
+        path=path,
+        state="queued",
+        pages_total=pages_total,
+        created_at=datetime.utcnow(),
+    )
+    db.add(job)
+    await db.commit()
+    return job
+
+
+def job_to_dict(job: IngestJob):
+    end = job.finished_at or datetime.utcnow()
+    elapsed = (end - job.started_at).total_seconds() if job.started_at else 0.0
+    return {
+        "id": job.id,
+        "filename": job.filename,
+        "state": job.state,
+        "error": job.error,
+        "file_id": job.file_id,
+        "pages_total": job.pages_total,
+        "pages_done": job.pages_done,
+        "chunks_done": job.chunks_done,
+        "chunks_new": job.chunks_new,
+        # Share of this upload's chunks that were already stored
+        "dedup_ratio": round(1 - (job.chunks_new or 0) / job.chunks_done, 4) if job.chunks_done else 0.0,
+        "bytes_saved": job.bytes_saved,
+        "chunks_per_second": round(job.chunks_done / elapsed, 1) if elapsed > 0 else 0.0,
+        "timings_ms": json.loads(job.timings) if job.timings else None,
+        "created_at": job.created_at.isoformat(),
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def claim_next_job(db: Session):
+    """Atomically move the fairest runnable job to 'running' and return its id.
+
+    Fairness: the job comes from the user with the fewest jobs currently
+    running, oldest job first, so one user's bulk upload cannot starve
+    everyone else.
+    """
+    stale = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+    runnable = or_(
+        IngestJob.state == "queued",
+        (IngestJob.state == "running") & (IngestJob.heartbeat_at < stale),
+    )
+    running = dict(
+        db.query(IngestJob.user_id, func.count(IngestJob.id))
+        .filter(IngestJob.state == "running", IngestJob.heartbeat_at >= stale)
+        .group_by(IngestJob.user_id)
+        .all()
+    )
+    candidates = db.query(IngestJob.id, IngestJob.user_id).filter(runnable).order_by(IngestJob.id).all()
+    for job_id, user_id in sorted(candidates, key=lambda c: (running.get(c[1], 0), c[0])):
+        now = datetime.utcnow()
+        # Compare-and-set: another worker (thread or process) may have won the race
+        claimed = db.execute(
+            update(IngestJob)
+            .where(IngestJob.id == job_id, runnable)
+            .values(state="running", heartbeat_at=now,
+                    started_at=func.coalesce(IngestJob.started_at, now))
+        ).rowcount
+        db.commit()
+        if claimed:
+            return job_id
+    return None
+
+
+def run_job(job_id: int, stop_event=None):
+    db = WriteSessionLocal()
+    try:
+        job = db.get(IngestJob, job_id)
+        path, filename, user_id = job.path, job.filename, job.user_id
+        pages_total, chunks_done, file_id = job.pages_total, job.chunks_done, job.file_id
+        # Hand the writer connection back while pages are extracted and embedded
+        db.commit()
+
+        def progress(db, file_id, chunks, new_chunks, bytes_saved, pages):
+            if stop_event is not None and stop_event.is_set():
+                # Shutting down: roll this batch back, the job resumes from
+                # its last committed batch on the next start
+                raise JobInterrupted()
+            job.file_id = file_id
+            job.chunks_done += chunks
+            job.chunks_new = (job.chunks_new or 0) + new_chunks
+            job.bytes_saved = (job.bytes_saved or 0) + bytes_saved
+            job.pages_done = max(job.pages_done, pages)
+            job.heartbeat_at = datetime.utcnow()
+
+        try:
+            result = ingest_pages(
+                iter_pages(path, num_pages=pages_total), filename, db, user_id,
+                skip_chunks=chunks_done, file_id=file_id, progress=progress,
+            )
+        except JobInterrupted:
+            db.rollback()
+            job.state = "queued"
+            db.commit()
+            return
+        except EmptyDocument:
+            db.rollback()
+            _finish(db, job, "failed", error="PDF is empty.")
+            return
+        except Exception as e:
+            db.rollback()
+            if job.file_id is not None:
+                # Batches committed before the failure would stay searchable
+                # as a truncated document: delete it the way a user would
+                try:
+                    delete_partial_upload(db, user_id, job.file_id)
+                except Exception as cleanup_error:
+                    db.rollback()
+                    print(f"Removing the partial upload of job {job_id} failed: {cleanup_error}")
+            _finish(db, job, "failed", error=str(e))
+            return
+
+        job.file_id = result["file_id"]
+        job.pages_done = job.pages_total
+        job.timings = json.dumps(result["timings"])
+        _finish(db, job, "done")
+    finally:
+        db.close()
+
+
+def _finish(db: Session, job: IngestJob, state, error=None):
+    job.state = state
+    job.error = error
+    job.finished_at = datetime.utcnow()
+    db.commit()
+    try:
+        os.remove(job.path)
+    except FileNotFoundError:
+        pass
+
+
+class JobWorkerPool:
+    def __init__(self, concurrency=INGEST_CONCURRENCY):
+        self.concurrency = concurrency
+        self._threads = []
+        self._running = set()
+        self._running_lock = threading.Lock()
+        self._wake = threading.Condition()
+        self._stop = threading.Event()
+
+    def start(self):
+        self._stop.clear()
+        for i in range(self.concurrency):
+            t = threading.Thread(target=self._work, name=f"ingest-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        t = threading.Thread(target=self._heartbeat, name="ingest-heartbeat", daemon=True)
+        t.start()
+        self._threads.append(t)
+
+    def stop(self, timeout=30):
+        self._stop.set()
+        self.notify()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def notify(self):
+        with self._wake:
+            self._wake.notify_all()
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                self._work_once()
+            except Exception as e:
+                # E.g. the database locked or unreachable: a job left running
+                # goes stale and is claimed again
+                print(f"Ingest worker failed: {e}")
+                self._stop.wait(JOB_POLL_SECONDS)
+
+    def _work_once(self):
+        db = SessionLocal()
+        try:
+            job_id = claim_next_job(db)
+        finally:
+            db.close()
+        if job_id is None:
+            # Idle until an upload arrives (or poll, to pick up jobs that
+            # other processes enqueued or abandoned)
+            with self._wake:
+                self._wake.wait(JOB_POLL_SECONDS)
+            return
+        with self._running_lock:
+            self._running.add(job_id)
+        try:
+            run_job(job_id, self._stop)
+        finally:
+            with self._running_lock:
+                self._running.discard(job_id)
+
+    def _heartbeat(self):
+        # Keeps long batches (slow embedders) from looking abandoned
+        while not self._stop.wait(JOB_HEARTBEAT_SECONDS):
+            with self._running_lock:
+                running = list(self._running)
+            if not running:
+                continue
+            try:
+                db = SessionLocal()
+                try:
+                    db.execute(
+                        update(IngestJob)
+                        .where(IngestJob.id.in_(running), IngestJob.state == "running")
+                        .values(heartbeat_at=datetime.utcnow())
+                    )
+                    db.commit()
+                finally:
+                    db.close()
+            except Exception as e:
+                # Retried on the next beat, well before the jobs go stale
+                print(f"Ingest heartbeat failed: {e}")
+
+
+job_workers = JobWorkerPool()
@@ -0,0 +1,170 @@
+import os
+import re
+from array import array
+from collections import Counter
+import numpy as np
+
+from database import SessionLocal, DocumentChunk, tombstoned_chunk_ids
+from embedding_store import embedding_store
+from vector_index import IndexCache, RowLookup, Tombstones, drop_dead
+
+# Memory the cached per-user lexical indexes may use, on top of the vector indexes
+LEXICAL_MEMORY_BUDGET_MB = int(os.getenv("LEXICAL_MEMORY_BUDGET_MB", "256"))
+
+# Okapi BM25 term-frequency saturation and length normalisation
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Rows fetched per round trip when building an index from the database
+LOAD_BATCH_ROWS = 5000
+
+_TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return _TOKEN.findall(text.casefold())
+
+
+class BM25Index(Tombstones):
+    """In-process inverted index over one user's chunk contents.
+
+    Each term maps to a posting list of (row, term frequency) pairs kept in
+    growable typed arrays, so uploads extend it in place. Rows are published
+    by bumping ``size`` last; a search only looks at rows below the size it
+    read, so concurrent adds are safe without a lock.
+    """
+
+    def __init__(self):
+        self._ids = array("q")
+        self._lengths = array("i")
+        self._postings = {}
+        self._nbytes = 0
+        self.size = 0
+        self._lookup = RowLookup(self.chunk_ids)
+
+    @property
+    def nbytes(self):
+        return self._nbytes + self._lookup.nbytes
+
+    def chunk_ids(self):
+        return np.array(self._ids[:self.size], dtype=np.int64)
+
+    def add(self, ids, texts):
+        for chunk_id, text in zip(ids, texts):
+            row = len(self._ids)
+            terms = Counter(tokenize(text))
+            for term, tf in terms.items():
+                posting = self._postings.get(term)
+                if posting is None:
+                    posting = self._postings[term] = (array("i"), array("i"))
+                    # Dict slot, key and the two array headers
+                    self._nbytes += 200 + len(term)
+                posting[0].append(row)
+                posting[1].append(tf)
+            self._nbytes += 8 * len(terms) + 12
+            self._ids.append(int(chunk_id))
+            self._lengths.append(sum(terms.values()))
+            self.size = row + 1
+
+    def search(self, query, top_k, candidates=None):
+        # Returns (chunk_ids, bm25_scores), best first; only chunks sharing a
+        # term with the query, and with `candidates` only those chunk ids
+        n = self.size
+        dead = self._dead
+        terms = set(tokenize(query))
+        if n == 0 or top_k <= 0 or not terms:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        allowed = None
+        if candidates is not None:
+            # Bitmap of the candidate rows; term statistics still cover every row
+            allowed = np.zeros(n, dtype=bool)
+            allowed[self._lookup.positions(candidates, n)] = True
+        lengths = np.frombuffer(self._lengths[:n], dtype=np.int32)
+        avg_length = max(float(lengths.mean()), 1.0)
+        all_rows, all_scores = [], []
+        for term in terms:
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            m = min(len(posting[0]), len(posting[1]))
+            rows = np.frombuffer(posting[0][:m], dtype=np.int32)
+            tf = np.frombuffer(posting[1][:m], dtype=np.int32).astype(np.float32)
+            visible = rows < n
+            rows, tf = rows[visible], tf[visible]
+            df = len(rows)
+            idf = np.log1p((n - df + 0.5) / (df + 0.5))
+            if allowed is not None:
+                keep = allowed[rows]
+                rows, tf = rows[keep], tf[keep]
+            all_rows.append(rows)
+            norm = BM25_K1 * (1.0 - BM25_B + BM25_B * lengths[rows] / avg_length)
+            all_scores.append(idf * tf * (BM25_K1 + 1.0) / (tf + norm))
+        if not all_rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        rows, inverse = np.unique(np.concatenate(all_rows), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(all_scores)).astype(np.float32)
+        fetch = top_k + len(dead)
+        k = min(fetch, len(rows))
+        if k < len(rows):
+            # Everything tied with the k-th score competes, so the cut does
+            # not depend on how many results were asked for
+            kth = -np.partition(-scores, k - 1)[k - 1]
+            top = np.flatnonzero(scores >= kth)
+        else:
+            top = np.arange(len(rows))
+        # Ties go to the earlier chunk
+        top = top[np.lexsort((rows[top], -scores[top]))][:k]
+        ids = np.frombuffer(self._ids[:n], dtype=np.int64)
+        return drop_dead(ids[rows[top]], scores[top], dead, top_k)
+
+
+def load_lexical_index(user_id: int):
+    index = BM25Index()
+    db = SessionLocal()
+    try:
+        rows = db.query(DocumentChunk.id, DocumentChunk.content) \
+            .filter(DocumentChunk.user_id == user_id) \
+            .order_by(DocumentChunk.id) \
+            .yield_per(LOAD_BATCH_ROWS)
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == LOAD_BATCH_ROWS:
+                index.add(*zip(*batch))
+                batch = []
+        if batch:
+            index.add(*zip(*batch))
+    finally:
+        db.close()
+    index.delete(tombstoned_chunk_ids(user_id))
+    return index
+
+
+def update_lexical_index(user_id: int, index, start):
+    """Add postings for the chunks appended to the user's embedding segment
+    from row ``start`` on and apply the current tombstones. Returns the
+    segment rows now seen."""
+    ids, _, rows = embedding_store.load_since(user_id, start)
+    # Rows this process appended were added to the index already
+    ids = ids[~np.isin(ids, index.chunk_ids())].tolist()
+    if ids:
+        db = SessionLocal()
+        try:
+            for batch_start in range(0, len(ids), LOAD_BATCH_ROWS):
+                batch = db.query(DocumentChunk.id, DocumentChunk.content) \
+                    .filter(DocumentChunk.user_id == user_id,
+                            DocumentChunk.id.in_(ids[batch_start:batch_start + LOAD_BATCH_ROWS])) \
+                    .order_by(DocumentChunk.id) \
+                    .all()
+                if batch:
+                    index.add(*zip(*batch))
+        finally:
+            db.close()
+    index.replace_dead(tombstoned_chunk_ids(user_id))
+    return rows
+
+
+lexical_indexes = IndexCache(LEXICAL_MEMORY_BUDGET_MB * 1024 * 1024, loader=load_lexical_index,
+                             updater=update_lexical_index, name="lexical")
@@ -1,45 +1,85 @@
 from fastapi import FastAPI, UploadFile, File, Form, Depends, HTTPException, status, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-import PyPDF2
-from typing import List
+from pydantic import BaseModel, Field
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+from collections import deque
+from datetime import datetime
+import json
 import os
+import numpy as np
 
-from database import init_db, get_db, User, UploadedFile
-from rag import generate_answer, process_and_save_pdf_text
-from auth import get_password_hash, verify_password, create_access_token, get_current_user
+from database import init_db, get_async_db, has_legacy_embeddings, AsyncSessionLocal, User, UploadedFile, IngestJob
+from rag import (generate_answer_async, stream_answer_async, answer_batch_async, embedder, ChunkFilter,
+                 DEFAULT_TOP_K, MAX_TOP_K, MAX_BATCH_QUESTIONS)
+from query_cache import query_cache
+from pdf_extract import save_upload, shutdown_pool, UnreadablePdf
+from jobs import enqueue_job, job_to_dict, job_workers, UPLOAD_DIR
+from compaction import delete_document_async, compactor, user_fragmentation, DocumentBusy
+from index_sync import index_sync
+from metrics import MetricsMiddleware, METRICS_ENABLED, registry, stage
+from vector_index import user_indexes
+from lexical_index import lexical_indexes
+from auth import get_password_hash_async, verify_password_async, create_access_token, get_current_user, token_cache, AuthUser
 
 # App state
 app = FastAPI()
+# Per-route latency histograms, and stage profiles for requests sent with X-Profile: 1
+app.add_middleware(MetricsMiddleware)
+# (ttft_ms, total_ms) of recent streamed answers, reported by /stats
+stream_latencies = deque(maxlen=1000)
+
+# Initialize DB tables on startup, unless serve.py did so before starting
+# the workers (concurrent migrations would race)
+INIT_DB_ON_STARTUP = os.getenv("INIT_DB_ON_STARTUP", "1") == "1"
 
-# Initialize DB tables on startup
 @app.on_event("startup")
 def on_startup():
     try:
-        init_db()
-        print("Database connected and tables created.")
+        if INIT_DB_ON_STARTUP:
+            init_db()
+            print("Database connected and tables created.")
+        if has_legacy_embeddings():
+            print("Warning: embeddings still stored in SQL rows, run 'python migrate_embeddings.py'.")
     except Exception as e:
         print(f"Database connection failed: {e}")
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    # Also resumes jobs left queued or running by a previous run
+    job_workers.start()
+    compactor.start()
+    # Warm start, then picks up index changes made by other worker processes
+    index_sync.start()
+
+@app.on_event("shutdown")
+def on_shutdown():
+    index_sync.stop()
+    compactor.stop()
+    job_workers.stop()
+    shutdown_pool()
 
 # --- AUTH ENDPOINTS ---
 
 @app.post("/register")
-async def register(username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
-    db_user = db.query(User).filter(User.username == username).first()
-    if db_user:
+async def register(username: str = Form(...), password: str = Form(...), db: AsyncSession = Depends(get_async_db)):
+    result = await db.execute(select(User).where(User.username == username))
+    if result.scalars().first():
         raise HTTPException(status_code=400, detail="Username already registered")
     
-    hashed_pw = get_password_hash(password)
+    # bcrypt is deliberately slow, keep it off the event loop
+    hashed_pw = await get_password_hash_async(password)
     new_user = User(username=username, hashed_password=hashed_pw)
     db.add(new_user)
-    db.commit()
+    await db.commit()
     return {"message": "User created successfully"}
 
 @app.post("/login")
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    result = await db.execute(select(User).where(User.username == form_data.username))
+    user = result.scalars().first()
+    if not user or not await verify_password_async(form_data.password, user.hashed_password):
         raise HTTPException(status_code=400, detail="Incorrect username or password")
     
     access_token = create_access_token(data={"sub": user.username})
@@ -48,39 +88,192 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session =
 # --- RAG ENDPOINTS ---
 
 @app.get("/documents")
-async def get_documents(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    files = db.query(UploadedFile).filter(UploadedFile.user_id == current_user.id).all()
-    return [{"id": f.id, "filename": f.filename, "date": f.upload_date} for f in files]
+async def get_documents(db: AsyncSession = Depends(get_async_db), current_user: AuthUser = Depends(get_current_user)):
+    result = await db.execute(select(UploadedFile).where(
+        UploadedFile.user_id == current_user.id, UploadedFile.deleted_at.is_(None)))
+    files = result.scalars().all()
+    return [{"id": f.id, "filename": f.filename, "date": f.upload_date.strftime("%Y-%m-%d %H:%M")} for f in files]
+
+@app.delete("/documents/{file_id}")
+async def delete_document(file_id: int, db: AsyncSession = Depends(get_async_db), current_user: AuthUser = Depends(get_current_user)):
+    # Chunks are tombstoned right away; the background compactor reclaims the space
+    try:
+        tombstoned = await delete_document_async(db, current_user.id, file_id)
+    except DocumentBusy:
+        raise HTTPException(status_code=409, detail="Document is still being indexed")
+    if tombstoned is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return {"message": "Document deleted", "chunks_tombstoned": tombstoned}
 
-@app.post("/upload-pdf")
+@app.post("/upload-pdf", status_code=status.HTTP_202_ACCEPTED)
 async def upload_pdf(
     file: UploadFile = File(...), 
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: AuthUser = Depends(get_current_user)
 ):
+    # Ingestion runs in the background job queue; poll GET /jobs/{id} for progress
+    with stage("save_upload"):
+        path = await run_in_threadpool(save_upload, file.file, UPLOAD_DIR)
     try:
-        reader = PyPDF2.PdfReader(file.file)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() or ""
-        
-        if not text.strip():
-            return JSONResponse(status_code=400, content={"detail": "PDF is empty."})
-
-        num_chunks = process_and_save_pdf_text(text, file.filename, db, current_user.id)
-        return {"message": f"Successfully indexed '{file.filename}'", "chunks": num_chunks}
-    except Exception as e:
-        return JSONResponse(status_code=500, content={"detail": f"Server Error: {str(e)}"})
+        with stage("enqueue"):
+            job = await enqueue_job(db, current_user.id, file.filename, path)
+    except UnreadablePdf as e:
+        os.remove(path)
+        return JSONResponse(status_code=400, content={"detail": f"Could not read PDF: {str(e)}"})
+    except Exception:
+        # Not the upload's fault (e.g. the database is down): a 500
+        os.remove(path)
+        raise
+    job_workers.notify()
+    return {"message": f"Queued '{file.filename}' for indexing", "job_id": job.id, "state": job.state}
+
+@app.get("/jobs")
+async def list_jobs(db: AsyncSession = Depends(get_async_db), current_user: AuthUser = Depends(get_current_user)):
+    result = await db.execute(
+        select(IngestJob).where(IngestJob.user_id == current_user.id).order_by(IngestJob.id.desc()).limit(100)
+    )
+    return [job_to_dict(j) for j in result.scalars().all()]
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: int, db: AsyncSession = Depends(get_async_db), current_user: AuthUser = Depends(get_current_user)):
+    result = await db.execute(select(IngestJob).where(IngestJob.id == job_id, IngestJob.user_id == current_user.id))
+    job = result.scalars().first()
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_to_dict(job)
+
+def make_filter(file_ids=None, filename=None, uploaded_after=None, uploaded_before=None):
+    if file_ids is None and not filename and uploaded_after is None and uploaded_before is None:
+        return None
+    return ChunkFilter(tuple(file_ids) if file_ids is not None else None, filename or None,
+                       uploaded_after, uploaded_before)
+
+def query_filter(
+    file_ids: Optional[List[int]] = Form(None),
+    filename: Optional[str] = Form(None),
+    uploaded_after: Optional[datetime] = Form(None),
+    uploaded_before: Optional[datetime] = Form(None)
+):
+    # Optional form fields limiting retrieval to some of the user's files
+    return make_filter(file_ids, filename, uploaded_after, uploaded_before)
 
 @app.post("/query")
 async def query_endpoint(
     question: str = Form(...), 
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    top_k: int = Form(DEFAULT_TOP_K, ge=1, le=MAX_TOP_K),
+    chunk_filter: Optional[ChunkFilter] = Depends(query_filter),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: AuthUser = Depends(get_current_user)
 ):
-    answer = generate_answer(question, db, current_user.id)
+    answer = await generate_answer_async(question, db, current_user.id, top_k, chunk_filter)
     return {"answer": answer}
 
+@app.post("/query/stream")
+async def query_stream_endpoint(
+    question: str = Form(...),
+    top_k: int = Form(DEFAULT_TOP_K, ge=1, le=MAX_TOP_K),
+    chunk_filter: Optional[ChunkFilter] = Depends(query_filter),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: AuthUser = Depends(get_current_user)
+):
+    # Server-sent events: sources first, then answer tokens, then timings
+    events = await stream_answer_async(question, db, current_user.id, top_k, chunk_filter)
+
+    async def sse():
+        async for event, data in events:
+            if event == "done" and data["ttft_ms"] is not None:
+                stream_latencies.append((data["ttft_ms"], data["total_ms"]))
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(sse(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+class BatchQuery(BaseModel):
+    questions: List[str] = Field(..., min_length=1, max_length=MAX_BATCH_QUESTIONS)
+    top_k: int = Field(DEFAULT_TOP_K, ge=1, le=MAX_TOP_K)
+    # Newline-delimited JSON, one result per line as soon as it is ready
+    stream: bool = False
+    # Same filters as /query
+    file_ids: Optional[List[int]] = None
+    filename: Optional[str] = None
+    uploaded_after: Optional[datetime] = None
+    uploaded_before: Optional[datetime] = None
+
+@app.post("/query/batch")
+async def query_batch_endpoint(
+    batch: BatchQuery,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: AuthUser = Depends(get_current_user)
+):
+    chunk_filter = make_filter(batch.file_ids, batch.filename, batch.uploaded_after, batch.uploaded_before)
+    if not batch.stream:
+        results = [r async for r in answer_batch_async(batch.questions, db, current_user.id, batch.top_k, chunk_filter)]
+        return {"results": results}
+
+    user_id = current_user.id
+
+    async def ndjson():
+        # The request's session is closed once the handler returns, the stream gets its own
+        async with AsyncSessionLocal() as stream_db:
+            async for result in answer_batch_async(batch.questions, stream_db, user_id, batch.top_k, chunk_filter):
+                yield json.dumps(result) + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+def latency_summary(samples):
+    if not samples:
+        return {"count": 0}
+    ms = np.array(samples)
+    return {"count": len(ms), **{f"p{p}_ms": round(float(np.percentile(ms, p)), 2) for p in (50, 95, 99)}}
+
+@app.get("/stats")
+async def stats(current_user: AuthUser = Depends(get_current_user)):
+    # Process-wide cache figures, plus the caller's own storage; every user's
+    # is in the compaction report (python compaction.py)
+    latencies = list(stream_latencies)
+    last_run = compactor.last_run
+    return {
+        "auth_cache": token_cache.stats(),
+        "embedding_cache": embedder.stats(),
+        "query_cache": query_cache.stats(),
+        "compaction": {
+            "fragmentation": await run_in_threadpool(user_fragmentation, current_user.id),
+            "last_run_at": last_run["finished_at"] if last_run else None,
+        },
+        "indexes": {
+            "cached_users": len(user_indexes.users()),
+            "memory_bytes": user_indexes.memory_usage() + lexical_indexes.memory_usage(),
+            "warmed": index_sync.warmed,
+        },
+        "query_stream": {
+            "ttft": latency_summary([ttft for ttft, _ in latencies]),
+            "total": latency_summary([total for _, total in latencies]),
+        },
+    }
+
+@registry.collector
+def cache_metrics():
+    # Query cache hits are counted per request, see rag_query_cache_hits_total
+    caches = {"auth": token_cache.stats(), "embedding": embedder.stats()}
+    entries = {**caches, "query": query_cache.stats()}
+    return [
+        ("rag_cache_hits_total", "counter", "Cache lookups that found an entry",
+         [({"cache": name}, s["hits"]) for name, s in caches.items()]),
+        ("rag_cache_misses_total", "counter", "Cache lookups that found nothing",
+         [({"cache": name}, s["misses"]) for name, s in caches.items()]),
+        ("rag_cache_entries", "gauge", "Entries held by each cache",
+         [({"cache": name}, s["size"]) for name, s in entries.items()]),
+        ("rag_index_memory_bytes", "gauge", "Memory used by the cached per-user indexes",
+         [({"index": "vector"}, user_indexes.memory_usage()), ({"index": "lexical"}, lexical_indexes.memory_usage())]),
+    ]
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # Prometheus text exposition format
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/", response_class=HTMLResponse)
 async def root():
     html_content = """
@@ -222,10 +415,26 @@ async def root():
                         headers: { 'Authorization': `Bearer ${token}` }
                     });
                     const data = await res.json();
-                    if (res.ok) { alert(data.message); loadHistory(); } else alert(data.detail);
+                    if (!res.ok) return alert(data.detail);
+                    const job = await waitForJob(data.job_id);
+                    loadHistory();
+                    if (job.state === 'done') alert(`Indexed '${job.filename}' (${job.chunks_done} chunks)`);
+                    else alert(job.error || job.detail || "Indexing failed");
                 } catch(e) { alert("Upload failed"); }
             }
 
+            async function waitForJob(id) {
+                const list = document.getElementById('historyList');
+                while (true) {
+                    const res = await fetch(`/jobs/${id}`, { headers: { 'Authorization': `Bearer ${token}` } });
+                    const job = await res.json();
+                    if (!res.ok || job.state === 'done' || job.state === 'failed') return job;
+                    list.innerHTML = `<div class="history-item"><span>Indexing ${job.filename}...</span>
+                        <span class="history-date">${job.pages_done}/${job.pages_total} pages, ${job.chunks_done} chunks</span></div>`;
+                    await new Promise(r => setTimeout(r, 1000));
+                }
+            }
+
             async function askQuestion() {
                 const q = document.getElementById('question').value;
                 if (!q) return;
@@ -233,12 +442,41 @@ async def root():
                 d.style.display = 'block'; d.innerText = "Thinking...";
                 const fd = new FormData(); fd.append('question', q);
                 try {
-                    const res = await fetch('/query', { 
+                    const res = await fetch('/query/stream', { 
                         method: 'POST', body: fd, 
                         headers: { 'Authorization': `Bearer ${token}` }
                     });
-                    const data = await res.json();
-                    d.innerText = data.answer || data.detail;
+                    if (!res.ok) {
+                        const data = await res.json();
+                        d.innerText = data.detail || "Query error";
+                        return;
+                    }
+                    // Render server-sent events as they arrive
+                    const reader = res.body.getReader();
+                    const decoder = new TextDecoder();
+                    let buffer = '', header = '', answer = '';
+                    while (true) {
+                        const { value, done } = await reader.read();
+                        if (done) break;
+                        buffer += decoder.decode(value, { stream: true });
+                        let sep;
+                        while ((sep = buffer.indexOf('\\n\\n')) >= 0) {
+                            const frame = buffer.slice(0, sep);
+                            buffer = buffer.slice(sep + 2);
+                            const event = frame.match(/^event: (.*)$/m)[1];
+                            const data = JSON.parse(frame.match(/^data: (.*)$/m)[1]);
+                            if (event === 'sources') {
+                                const names = [...new Set(data.map(s => s.filename))];
+                                header = names.length ? `Sources: ${names.join(', ')}\\n\\n` : '';
+                                d.innerText = header;
+                            } else if (event === 'token') {
+                                answer += data.text;
+                                d.innerText = header + answer;
+                            } else if (event === 'done') {
+                                d.innerText = header + answer + `\\n\\n(first token ${data.ttft_ms} ms, total ${data.total_ms} ms)`;
+                            }
+                        }
+                    }
                 } catch(e) { d.innerText = "Query error"; }
             }
 
@@ -250,5 +488,6 @@ async def root():
     return HTMLResponse(content=html_content)
 
 if __name__ == "__main__":
+    # Development server; use serve.py for several workers
     import uvicorn
     uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
@@ -0,0 +1,274 @@
+"""Counters, latency histograms and per-request stage profiles.
+
+Code under measurement wraps its steps in ``stage(name)`` and reports work
+with ``count(name, amount)``. Both feed the process-wide metrics served in
+the Prometheus text format by ``GET /metrics``, and, for a request sent
+with ``X-Profile: 1``, a breakdown returned in the response headers:
+
+    Server-Timing: embed;dur=0.41, vector_search;dur=3.2, ...
+    X-Profile: {"total_ms": 5.1, "stages_ms": {...}, "counts": {...}}
+
+Stages nest (``vector_search`` contains ``distance`` and ``top_k``), so the
+stage times of a profile do not add up to its total. The profile covers the
+work done before the response headers are sent; for streamed responses that
+is retrieval, not generation.
+
+With METRICS_ENABLED=0 a ``stage`` or ``count`` outside a profiled request
+costs one flag check and one context variable lookup.
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import nullcontext
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# Request header asking for a stage breakdown, and the response header carrying it
+PROFILE_HEADER = "X-Profile"
+
+# Upper bounds in seconds; stages run from tens of microseconds to seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] += amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield self.name + _labels(self.labels, label_values), value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        slot = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][slot] += 1
+            series[1] += value
+
+    def samples(self):
+        with self._lock:
+            series = sorted((key, (list(counts), total)) for key, (counts, total) in self._series.items())
+        for label_values, (counts, total) in series:
+            cumulative = 0
+            for bound, n in zip((*self.buckets, float("inf")), counts):
+                cumulative += n
+                yield self.name + "_bucket" + _labels(self.labels, label_values, [("le", _number(bound))]), cumulative
+            yield self.name + "_sum" + _labels(self.labels, label_values), total
+            yield self.name + "_count" + _labels(self.labels, label_values), cumulative
+
+
+class Registry:
+    """Metrics rendered by ``render()``, plus collectors read at scrape time.
+
+    A collector returns ``(name, type, help, [(labels_dict, value), ...])``
+    tuples, for values other modules already keep (cache hit counts,
+    memory in use) and that would be wasteful to mirror on every update.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, collect):
+        self._collectors.append(collect)
+        return collect
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{sample} {_number(value)}" for sample, value in metric.samples())
+        for collect in self._collectors:
+            for name, kind, help, samples in collect():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_labels(labels.keys(), labels.values())} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_request_seconds = registry.histogram(
+    "rag_http_request_duration_seconds", "Time from request to the end of the response body",
+    ("method", "route", "status"))
+stage_seconds = registry.histogram(
+    "rag_stage_duration_seconds", "Time spent in each retrieval and ingestion stage", ("stage",))
+
+COUNTERS = {
+    "chunks_scanned": registry.counter("rag_chunks_scanned_total", "Chunks scored by vector searches"),
+    "bytes_read": registry.counter(
+        "rag_bytes_read_total", "Vector and code bytes scanned plus chunk content bytes fetched"),
+    "query_cache_hits": registry.counter("rag_query_cache_hits_total", "Answers served from the query cache"),
+    "query_cache_misses": registry.counter("rag_query_cache_misses_total", "Answers computed after a cache miss"),
+    "chunks_ingested": registry.counter("rag_chunks_ingested_total", "Chunks read from uploaded documents"),
+}
+
+
+class Profile:
+    """Stage times and counts of one request."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    def server_timing(self):
+        return ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in self.stages.items())
+
+    def to_json(self):
+        return json.dumps({
+            "total_ms": round((time.perf_counter() - self.start) * 1000, 3),
+            "stages_ms": {name: round(seconds * 1000, 3) for name, seconds in self.stages.items()},
+            "counts": dict(self.counts),
+        })
+
+
+# Set per request by MetricsMiddleware; copied into asyncio.to_thread and
+# threadpool calls, which add to the same Profile object
+_profile = contextvars.ContextVar("profile", default=None)
+_NO_STAGE = nullcontext()
+
+
+class _Stage:
+    __slots__ = ("name", "profile", "start")
+
+    def __init__(self, name, profile):
+        self.name = name
+        self.profile = profile
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_stage(self.name, time.perf_counter() - self.start, self.profile)
+
+
+def stage(name):
+    """Context manager timing one stage; a no-op when nothing would record it."""
+    profile = _profile.get()
+    if not METRICS_ENABLED and profile is None:
+        return _NO_STAGE
+    return _Stage(name, profile)
+
+
+def record_stage(name, seconds, profile=None):
+    # For stages timed elsewhere, e.g. the ingestion timings
+    if METRICS_ENABLED:
+        stage_seconds.observe(seconds, name)
+    if profile is not None:
+        profile.stages[name] += seconds
+
+
+def count(name, amount=1):
+    profile = _profile.get()
+    if METRICS_ENABLED:
+        COUNTERS[name].inc(amount)
+    if profile is not None:
+        profile.counts[name] += amount
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request latency per route, and returning
+    the stage profile of requests that ask for one."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        profile = None
+        for name, value in scope["headers"]:
+            if name == b"x-profile" and value not in (b"", b"0"):
+                profile = Profile()
+        if not METRICS_ENABLED and profile is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_profile(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if profile is not None:
+                    message["headers"] = [
+                        *message.get("headers", []),
+                        (b"server-timing", profile.server_timing().encode()),
+                        (PROFILE_HEADER.lower().encode(), profile.to_json().encode()),
+                    ]
+            await send(message)
+
+        token = _profile.set(profile)
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            _profile.reset(token)
+            if METRICS_ENABLED:
+                # The route template, so /jobs/1 and /jobs/2 share a series
+                route = scope.get("route")
+                http_request_seconds.observe(time.perf_counter() - start, scope["method"],
+                                             getattr(route, "path", "unmatched"), str(status))
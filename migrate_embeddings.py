@@ -0,0 +1,73 @@
+from sqlalchemy import text
+import numpy as np
+from database import SessionLocal, engine, init_db, DocumentChunk, User, USE_SQLITE
+from embedding_store import embedding_store
+
+BATCH_SIZE = 10000
+
+def copy_embeddings(db):
+    # Copy every SQL blob into the owner's on-disk segment. Rows already in the
+    # store are skipped, so an interrupted run can simply be restarted.
+    total = 0
+    for (user_id,) in db.query(User.id).all():
+        stored = set(embedding_store.load(user_id)[0].tolist())
+        rows = (
+            db.query(DocumentChunk.id, DocumentChunk.embedding)
+            .filter(DocumentChunk.user_id == user_id, DocumentChunk.embedding.isnot(None))
+            .order_by(DocumentChunk.id)
+            .yield_per(BATCH_SIZE)
+        )
+        batch = []
+        for chunk_id, blob in rows:
+            if chunk_id not in stored:
+                batch.append((chunk_id, blob))
+            if len(batch) == BATCH_SIZE:
+                total += _flush(user_id, batch)
+                batch = []
+        total += _flush(user_id, batch)
+    return total
+
+def _flush(user_id, batch):
+    if not batch:
+        return 0
+    ids = np.array([chunk_id for chunk_id, _ in batch], dtype=np.int64)
+    vectors = np.frombuffer(b"".join(blob for _, blob in batch), dtype=np.float32).reshape(len(batch), -1)
+    embedding_store.append(user_id, ids, vectors)
+    return len(batch)
+
+def drop_sql_embeddings():
+    # Clear the blobs and relax the old NOT NULL constraint on the column
+    with engine.begin() as conn:
+        if USE_SQLITE:
+            # SQLite cannot alter a column constraint, rebuild the table instead.
+            # Keep file_chunks pointing at document_chunks across the rename.
+            conn.execute(text("PRAGMA legacy_alter_table=ON"))
+            conn.execute(text("ALTER TABLE document_chunks RENAME TO document_chunks_old"))
+            for index in DocumentChunk.__table__.indexes:
+                conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+            DocumentChunk.__table__.create(conn)
+            conn.execute(text(
+                "INSERT INTO document_chunks (id, content, embedding, content_hash, user_id, file_id) "
+                "SELECT id, content, NULL, content_hash, user_id, file_id FROM document_chunks_old"
+            ))
+            conn.execute(text("DROP TABLE document_chunks_old"))
+        else:
+            conn.execute(text("ALTER TABLE document_chunks ALTER COLUMN embedding DROP NOT NULL"))
+            conn.execute(text("UPDATE document_chunks SET embedding = NULL"))
+    if USE_SQLITE:
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("VACUUM"))
+
+def migrate():
+    init_db()
+    db = SessionLocal()
+    try:
+        copied = copy_embeddings(db)
+    finally:
+        db.close()
+    print(f"Copied {copied} embeddings to {embedding_store.root}")
+    drop_sql_embeddings()
+    print("Removed embedding blobs from the database.")
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,170 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import PyPDF2
+from PyPDF2.generic import IndirectObject, NameObject
+
+# Page text extraction runs in worker processes, off the event loop and the GIL
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+PAGES_PER_TASK = 8
+# Extraction tasks in flight per document; bounds memory for huge PDFs
+MAX_TASKS_IN_FLIGHT = 2 * PDF_WORKERS
+
+# Page attributes a page takes from its ancestors in the page tree
+INHERITED_PAGE_ATTRIBUTES = ("/Resources", "/MediaBox", "/CropBox", "/Rotate")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class UnreadablePdf(ValueError):
+    pass
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: forking a process that already runs threads (uvicorn, the
+            # job workers) is not safe
+            _pool = ProcessPoolExecutor(PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
+
+
+def _discard_pool(pool):
+    # A broken executor refuses all further work: the next get_pool()
+    # starts a new one
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def page_range(reader, start, stop):
+    """The pages [start, stop) of a document.
+
+    reader.pages resolves every page of the document on first use; this
+    walks down the page tree by the /Count of each subtree instead, so a
+    fresh reader per task only reads the pages it extracts.
+    """
+    pages = []
+
+    def walk(ref, first, inherited):
+        node = ref.get_object()
+        if "/Kids" not in node:
+            page = PyPDF2.PageObject(reader, ref if isinstance(ref, IndirectObject) else None)
+            page.update(inherited)
+            page.update(node)
+            pages.append(page)
+            return
+        inherited = {**inherited, **{NameObject(name): node[name] for name in INHERITED_PAGE_ATTRIBUTES
+                                     if name in node}}
+        kids = node["/Kids"]
+        if node.get("/Count") == len(kids):
+            # Only pages below this node: go straight to the wanted ones
+            for i in range(max(start - first, 0), min(stop - first, len(kids))):
+                walk(kids[i], first + i, inherited)
+            return
+        for kid in kids:
+            if first >= stop:
+                break
+            kid_node = kid.get_object()
+            count = kid_node.get("/Count", 0) if "/Kids" in kid_node else 1
+            if first + count > start:
+                walk(kid, first, inherited)
+            first += count
+
+    try:
+        walk(reader.trailer["/Root"].get_object()["/Pages"], 0, {})
+    except (KeyError, TypeError, AttributeError):
+        pages = None
+    if pages is None or len(pages) != stop - start:
+        # Malformed page tree (e.g. a wrong /Count): take the slow path
+        return [reader.pages[i] for i in range(start, stop)]
+    return pages
+
+
+def _extract_pages(path, start, stop):
+    # A reader per task over the open file: PdfReader(path) reads the whole
+    # file into memory, and a reader kept between tasks holds on to every
+    # object it resolved, so memory would grow with the document
+    with open(path, "rb") as f:
+        reader = PyPDF2.PdfReader(f)
+        return [page.extract_text() or "" for page in page_range(reader, start, stop)]
+
+
+def count_pages(path):
+    with open(path, "rb") as f:
+        try:
+            return len(PyPDF2.PdfReader(f).pages)
+        except OSError:
+            raise
+        except Exception as e:
+            # PyPDF2 reports malformed files through its own errors and
+            # through whatever lookup fails on them (KeyError, AttributeError)
+            raise UnreadablePdf(str(e)) from e
+
+
+def iter_pages(path, start_page=0, num_pages=None):
+    """Yield the text of each page in order, extracted in parallel worker processes."""
+    if num_pages is None:
+        num_pages = count_pages(path)
+    retried = False
+    while True:
+        pool = get_pool()
+        pages = _extract_in_pool(pool, path, start_page, num_pages)
+        try:
+            for text in pages:
+                yield text
+                start_page += 1
+            return
+        except BrokenProcessPool:
+            # A worker died (crash, OOM kill) and took the pool with it; the
+            # pages not yielded yet are extracted once more by a new pool
+            _discard_pool(pool)
+            if retried:
+                raise
+            retried = True
+        finally:
+            pages.close()
+
+
+def _extract_in_pool(pool, path, start_page, num_pages):
+    ranges = iter([(s, min(s + PAGES_PER_TASK, num_pages)) for s in range(start_page, num_pages, PAGES_PER_TASK)])
+    in_flight = deque()
+    for task in ranges:
+        in_flight.append(pool.submit(_extract_pages, path, *task))
+        if len(in_flight) >= MAX_TASKS_IN_FLIGHT:
+            break
+    try:
+        while in_flight:
+            texts = in_flight.popleft().result()
+            task = next(ranges, None)
+            if task is not None:
+                in_flight.append(pool.submit(_extract_pages, path, *task))
+            yield from texts
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+def save_upload(fileobj, directory=None, suffix=".pdf"):
+    # Worker processes read the PDF by path, so spool the upload to disk once
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=directory)
+    with os.fdopen(fd, "wb") as out:
+        shutil.copyfileobj(fileobj, out, 1024 * 1024)
+    return path
@@ -0,0 +1,175 @@
+import os
+import numpy as np
+
+# Compressed codes the vector index scans instead of float32 rows:
+# "none", "float16", "int8" (per-vector scale) or "pq" (product quantization)
+VECTOR_QUANTIZATION = os.getenv("VECTOR_QUANTIZATION", "none")
+# Best approximate matches re-scored exactly from the float32 segment (0: off)
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "100"))
+
+# Product quantization: each vector is cut into PQ_SUBVECTORS pieces (the
+# dimension must divide evenly), each stored as the 1-byte id of its nearest
+# centroid. The codebooks are trained per user on a sample of their vectors.
+PQ_SUBVECTORS = int(os.getenv("PQ_SUBVECTORS", "48"))
+PQ_CENTROIDS = 256
+PQ_TRAIN_POINTS = 16384
+PQ_KMEANS_ITERS = 10
+# Rows assigned per step while training/encoding, bounds the
+# (rows x centroids) distance matrix
+PQ_BLOCK_ROWS = 4096
+
+
+class Float16Codec:
+    """Half-precision copy of each vector: 2 bytes per dimension."""
+
+    name = "float16"
+    trained = True
+    min_train_rows = max_train_rows = 0
+    nbytes = 0
+
+    def train(self, x):
+        pass
+
+    def encode(self, x):
+        return np.asarray(x, dtype=np.float16)
+
+    def prepare(self, q):
+        return np.asarray(q, dtype=np.float32)
+
+    def distances(self, q, codes):
+        # Squared L2 from the prepared query to every code
+        diff = codes.astype(np.float32) - q
+        return np.einsum("ij,ij->i", diff, diff)
+
+
+class Int8Codec:
+    """Symmetric int8 per dimension with one float32 scale per vector."""
+
+    name = "int8"
+    trained = True
+    min_train_rows = max_train_rows = 0
+    nbytes = 0
+
+    def train(self, x):
+        pass
+
+    @staticmethod
+    def _empty(n, dim):
+        # ``norm`` caches scale^2 * ||codes||^2, the query-independent term
+        return np.empty(n, dtype=[("codes", np.int8, (dim,)), ("scale", np.float32), ("norm", np.float32)])
+
+    def encode(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        scale = np.abs(x).max(axis=1) / 127.0
+        scale[scale == 0] = 1.0
+        codes = np.rint(x / scale[:, None]).astype(np.int8)
+        out = self._empty(len(x), x.shape[1])
+        out["codes"] = codes
+        out["scale"] = scale
+        as_float = codes.astype(np.float32)
+        out["norm"] = scale * scale * np.einsum("ij,ij->i", as_float, as_float)
+        return out
+
+    def prepare(self, q):
+        q = np.asarray(q, dtype=np.float32)
+        return q, float(q @ q)
+
+    def distances(self, prepared, codes):
+        # ||q - s c||^2 = ||q||^2 - 2 s (c . q) + s^2 ||c||^2
+        q, q_norm = prepared
+        dots = codes["codes"].astype(np.float32) @ q
+        return q_norm - 2.0 * codes["scale"] * dots + codes["norm"]
+
+
+class PQCodec:
+    """Product quantization scanned with asymmetric distance computation:
+    the query stays float32 and is compared to every centroid once, then a
+    code's distance is a sum of ``subvectors`` table lookups.
+    """
+
+    name = "pq"
+    min_train_rows = PQ_CENTROIDS
+    max_train_rows = PQ_TRAIN_POINTS
+
+    def __init__(self, subvectors=PQ_SUBVECTORS, iters=PQ_KMEANS_ITERS, seed=0):
+        self.subvectors = subvectors
+        self.iters = iters
+        self.seed = seed
+        # (subvectors, PQ_CENTROIDS, dim // subvectors) once trained
+        self.codebooks = None
+        self._offsets = np.arange(subvectors, dtype=np.intp) * PQ_CENTROIDS
+
+    @property
+    def trained(self):
+        return self.codebooks is not None
+
+    @property
+    def nbytes(self):
+        return self.codebooks.nbytes if self.codebooks is not None else 0
+
+    def _split(self, x):
+        # (rows, dim) -> (subvectors, rows, dim // subvectors)
+        n, dim = x.shape
+        if dim % self.subvectors:
+            raise ValueError(f"PQ_SUBVECTORS={self.subvectors} does not divide the dimension {dim}")
+        return x.reshape(n, self.subvectors, dim // self.subvectors).transpose(1, 0, 2)
+
+    def _assign(self, sub, codebooks):
+        # Nearest centroid per subvector; ||x||^2 is the same for every centroid
+        # (a plain 2-D matmul per subvector beats one batched matmul here)
+        norms = np.einsum("mkd,mkd->mk", codebooks, codebooks)
+        labels = np.empty(sub.shape[:2], dtype=np.uint8)
+        for start in range(0, sub.shape[1], PQ_BLOCK_ROWS):
+            for m in range(self.subvectors):
+                d = sub[m, start:start + PQ_BLOCK_ROWS] @ codebooks[m].T
+                d *= -2.0
+                d += norms[m]
+                labels[m, start:start + len(d)] = d.argmin(axis=1)
+        return labels
+
+    def train(self, x):
+        # ``x`` is a sample of at most max_train_rows vectors
+        x = np.asarray(x, dtype=np.float32)
+        rng = np.random.default_rng(self.seed)
+        sub = np.ascontiguousarray(self._split(x))
+        m, n, dsub = sub.shape
+        codebooks = sub[:, rng.choice(n, size=PQ_CENTROIDS, replace=False)].copy()
+        # Flat (subvector, centroid) slot of every row, for one bincount per pass
+        base = (np.arange(m) * PQ_CENTROIDS)[:, None]
+        for _ in range(self.iters):
+            slots = (self._assign(sub, codebooks) + base).ravel()
+            counts = np.bincount(slots, minlength=m * PQ_CENTROIDS)
+            # Per-dimension sums: slot * dsub + dimension
+            cells = (slots[:, None] * dsub + np.arange(dsub)).ravel()
+            sums = np.bincount(cells, weights=sub.reshape(-1), minlength=m * PQ_CENTROIDS * dsub)
+            sums = sums.reshape(m, PQ_CENTROIDS, dsub)
+            counts = counts.reshape(m, PQ_CENTROIDS)
+            nonempty = counts > 0
+            codebooks[nonempty] = (sums[nonempty] / counts[nonempty, None]).astype(np.float32)
+        self.codebooks = codebooks
+
+    def encode(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        return np.ascontiguousarray(self._assign(self._split(x), self.codebooks).T)
+
+    def prepare(self, q):
+        # Squared distance from each query piece to each of its centroids
+        q = np.asarray(q, dtype=np.float32)
+        diff = self.codebooks - q.reshape(self.subvectors, 1, -1)
+        return np.einsum("mkd,mkd->mk", diff, diff).ravel()
+
+    def distances(self, table, codes):
+        return table[codes + self._offsets].sum(axis=1)
+
+
+CODECS = {"float16": Float16Codec, "int8": Int8Codec, "pq": PQCodec}
+
+
+def create_codec(name=None):
+    # None means float32, no quantization
+    name = name or VECTOR_QUANTIZATION
+    if name == "none":
+        return None
+    if name not in CODECS:
+        raise ValueError(f"Unknown vector quantization: {name}")
+    return CODECS[name]()
@@ -0,0 +1,136 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from typing import NamedTuple, Tuple
+
+from cache import LRUCache
+
+# Answers to repeated questions, keyed on (user, index version, question).
+# Uploads bump the version (see database.bump_index_version), so a cached
+# result can never outlive the documents it was computed from.
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "10000"))
+QUERY_CACHE_MAX_MB = int(os.getenv("QUERY_CACHE_MAX_MB", "64"))
+QUERY_CACHE_TTL_SECONDS = int(os.getenv("QUERY_CACHE_TTL_SECONDS", "600"))
+# Optional SQLite file shared by every worker pointing at it
+QUERY_CACHE_PATH = os.getenv("QUERY_CACHE_PATH")
+
+
+class CachedAnswer(NamedTuple):
+    chunk_ids: Tuple[int, ...]
+    answer: str
+
+
+def normalize_question(question):
+    return " ".join(question.split()).casefold()
+
+
+def _entry_size(key, value):
+    # Rough footprint: strings, ids and per-object overhead
+    return len(key[2]) + len(value.answer) + 8 * len(value.chunk_ids) + 200
+
+
+class DiskQueryCache:
+    def __init__(self, path, ttl, max_rows):
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS query_cache ("
+            "user_id INTEGER NOT NULL, question TEXT NOT NULL, version INTEGER NOT NULL, "
+            "chunk_ids TEXT NOT NULL, answer TEXT NOT NULL, expires_at REAL NOT NULL, "
+            "PRIMARY KEY (user_id, question))"
+        )
+
+    def get(self, user_id, version, question):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT chunk_ids, answer FROM query_cache "
+                "WHERE user_id = ? AND question = ? AND version = ? AND expires_at > ?",
+                (user_id, question, version, time.time()),
+            ).fetchone()
+        if row is None:
+            return None
+        return CachedAnswer(tuple(json.loads(row[0])), row[1])
+
+    def put(self, user_id, version, question, value):
+        with self._lock, self._conn:
+            # One row per question: a newer version replaces the stale answer
+            self._conn.execute(
+                "INSERT OR REPLACE INTO query_cache VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, question, version, json.dumps(value.chunk_ids), value.answer, time.time() + self.ttl),
+            )
+            self._puts += 1
+            if self._puts % 1000 == 0:
+                self._prune()
+
+    def invalidate(self, user_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM query_cache WHERE user_id = ?", (user_id,))
+
+    def _prune(self):
+        # Expired rows first, then the soonest to expire beyond max_rows
+        self._conn.execute("DELETE FROM query_cache WHERE expires_at <= ?", (time.time(),))
+        self._conn.execute(
+            "DELETE FROM query_cache WHERE rowid IN (SELECT rowid FROM query_cache "
+            "ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_rows,),
+        )
+
+
+class QueryCache:
+    """In-memory LRU of answers with an optional shared SQLite tier."""
+
+    def __init__(self, max_items=QUERY_CACHE_SIZE, max_bytes=QUERY_CACHE_MAX_MB * 1024 * 1024,
+                 ttl=QUERY_CACHE_TTL_SECONDS, path=QUERY_CACHE_PATH):
+        self.memory = LRUCache(max_items, ttl=ttl, max_bytes=max_bytes, sizeof=_entry_size)
+        self.disk = DiskQueryCache(path, ttl, max_items * 10) if path else None
+        self.disk_hits = 0
+        # Bumped by invalidate(); a result computed across an invalidation
+        # is not stored, as it may predate the change
+        self._epochs = defaultdict(int)
+
+    def epoch(self, user_id):
+        return self._epochs[user_id]
+
+    def get(self, user_id, version, question):
+        key = (user_id, version, question)
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(user_id, version, question)
+            if value is not None:
+                self.disk_hits += 1
+                self.memory.put(key, value)
+        return value
+
+    def put(self, user_id, version, question, value, epoch=None):
+        if epoch is not None and epoch != self._epochs[user_id]:
+            return
+        self.memory.put((user_id, version, question), value)
+        if self.disk is not None:
+            self.disk.put(user_id, version, question, value)
+
+    def invalidate(self, user_id):
+        # Called once the indexes reflect a change. Entries of older versions
+        # can no longer be hit; free their memory now. Answers stored under
+        # the new version by queries that searched the index before it was
+        # updated must go as well, from every tier.
+        self._epochs[user_id] += 1
+        if self.disk is not None:
+            self.disk.invalidate(user_id)
+        return self.memory.remove_where(lambda key, value: key[0] == user_id)
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats["max_bytes"] = self.memory.max_bytes
+        stats["disk_hits"] = self.disk_hits if self.disk is not None else None
+        return stats
+
+
+query_cache = QueryCache()
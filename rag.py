@@ -1,74 +1,536 @@
+import asyncio
+import hashlib
+import json
 import os
+import time
 import numpy as np
+from collections import defaultdict
 from datetime import datetime
+from itertools import chain, islice
+from typing import NamedTuple, Optional, Tuple
+from sqlalchemy import select
+from starlette.concurrency import iterate_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from database import DocumentChunk, save_chunk, UploadedFile
+from database import (DocumentChunk, FileChunk, UploadedFile, bump_index_version, get_index_version,
+                      chunk_ids_by_hash, insert_unique_chunks, insert_file_chunks, revive_chunks)
+from embedding_store import embedding_store
+from embeddings import create_embedder
+from generation import create_generator
+from lexical_index import lexical_indexes
+from metrics import count, record_stage, stage
+from query_cache import CachedAnswer, normalize_question, query_cache
+from vector_index import user_indexes
 
 # Configuration
 USE_MOCK = True
-EMBED_DIM = 384
+# Chunks embedded and committed together during ingestion
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "256"))
+# "hybrid" fuses BM25 and vector rankings, "vector" is L2 distance only
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+DEFAULT_TOP_K = 2
+MAX_TOP_K = 50
+# Candidates taken from each ranking before reciprocal rank fusion
+HYBRID_CANDIDATES = 50
+RRF_K = 60
+# Above this many chunks, vectors are only scored for the best BM25 matches
+PREFILTER_MIN_CHUNKS = int(os.getenv("PREFILTER_MIN_CHUNKS", "50000"))
+PREFILTER_CANDIDATES = 2000
+# /query/batch retrieves this many questions per matrix pass
+QUERY_BATCH_SIZE = 256
+MAX_BATCH_QUESTIONS = 10000
+
+class ChunkFilter(NamedTuple):
+    """Restricts retrieval to chunks of the user's files that match every
+    given condition. ``filename`` is a case-insensitive glob (``*``, ``?``)."""
+    file_ids: Optional[Tuple[int, ...]] = None
+    filename: Optional[str] = None
+    uploaded_after: Optional[datetime] = None
+    uploaded_before: Optional[datetime] = None
+
+    def cache_key(self):
+        return json.dumps([list(self.file_ids) if self.file_ids is not None else None, self.filename,
+                           *(d.isoformat() if d else None for d in (self.uploaded_after, self.uploaded_before))])
+
+def query_cache_key(question, top_k, chunk_filter=None):
+    if chunk_filter is None:
+        return f"{top_k}:{question}"
+    return f"{top_k}:{chunk_filter.cache_key()}:{question}"
+
+def _local_time(moment):
+    # upload_date is naive local time
+    return moment.astimezone().replace(tzinfo=None) if moment.tzinfo else moment
+
+def glob_to_like(pattern):
+    escaped = pattern.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped.replace("*", "%").replace("?", "_")
+
+embedder = create_embedder(use_mock=USE_MOCK)
+generator = create_generator(use_mock=USE_MOCK)
+
+def iter_chunks(pieces, chunk_size=500, overlap=100):
+    # Same windows as chunking the concatenated pieces, without ever holding
+    # more than the current piece plus one chunk of carry-over
+    step = chunk_size - overlap
+    buf = ""
+    for piece in pieces:
+        buf += piece
+        pos = 0
+        while pos + chunk_size <= len(buf):
+            yield buf[pos:pos + chunk_size]
+            pos += step
+        buf = buf[pos:]
+    pos = 0
+    while pos < len(buf):
+        yield buf[pos:pos + chunk_size]
+        pos += step
 
 def chunk_text(text, chunk_size=500, overlap=100):
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = min(start + chunk_size, len(text))
-        chunks.append(text[start:end])
-        start += chunk_size - overlap
-    return chunks
+    return list(iter_chunks([text], chunk_size, overlap))
 
 def get_embedding(text):
-    np.random.seed(hash(text) % (2**32))
-    return np.random.randn(EMBED_DIM).astype('float32')
+    with stage("embed"):
+        return embedder.embed_batch([text])[0]
+
+def reciprocal_rank_fusion(rankings, top_k, k=RRF_K):
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] += 1.0 / (k + rank + 1)
+    # Ties keep the order in which the rankings first listed the chunk
+    return sorted(scores, key=scores.get, reverse=True)[:top_k]
+
+def search_chunk_ids(query, user_id: int, top_k=DEFAULT_TOP_K, allowed=None):
+    # Index math only, no per-query database access, so async callers can
+    # run it in an executor. The per-user indexes are loaded on the first
+    # query and kept up to date by uploads. `allowed` (chunk ids, from
+    # filter_chunk_ids_async) limits which chunks are scored at all.
+    index = user_indexes.get(user_id)
+    if index.size == 0 or (allowed is not None and len(allowed) == 0):
+        return []
 
-def retrieve(query, db: Session, user_id: int, top_k=2):
     q = get_embedding(query).astype('float32')
-    
-    # Fetch only chunks belonging to the current user
-    db_chunks = db.query(DocumentChunk).filter(DocumentChunk.user_id == user_id).all()
-    if not db_chunks:
+    if RETRIEVAL_MODE != "hybrid":
+        with stage("vector_search"):
+            ids, _ = index.search(q, top_k, allowed)
+        return ids.tolist()
+
+    depth = max(top_k, HYBRID_CANDIDATES)
+    lexical = lexical_indexes.get(user_id)
+    with stage("lexical_search"):
+        lexical_ids, _ = lexical.search(query, max(depth, PREFILTER_CANDIDATES), allowed)
+    candidates = allowed
+    scored = index.size if allowed is None else len(allowed)
+    if scored >= PREFILTER_MIN_CHUNKS and len(lexical_ids) >= top_k:
+        # Large corpus: only score vectors of chunks that share terms with the question
+        candidates = lexical_ids
+    with stage("vector_search"):
+        vector_ids, _ = index.search(q, depth, candidates)
+    with stage("fuse"):
+        return reciprocal_rank_fusion([vector_ids.tolist(), lexical_ids[:depth].tolist()], top_k)
+
+def search_chunk_ids_batch(questions, user_id: int, top_k=DEFAULT_TOP_K, allowed=None):
+    # One embedding call and one blocked matrix pass for all questions. The
+    # lexical prefilter is skipped: the full scan is shared by the batch.
+    index = user_indexes.get(user_id)
+    if index.size == 0 or (allowed is not None and len(allowed) == 0):
+        return [[] for _ in questions]
+
+    with stage("embed"):
+        queries = embedder.embed_batch(questions)
+    if RETRIEVAL_MODE != "hybrid":
+        with stage("vector_search"):
+            return [ids.tolist() for ids, _ in index.search_batch(queries, top_k, allowed)]
+
+    depth = max(top_k, HYBRID_CANDIDATES)
+    lexical = lexical_indexes.get(user_id)
+    with stage("vector_search"):
+        vector_results = index.search_batch(queries, depth, allowed)
+    results = []
+    for question, (vector_ids, _) in zip(questions, vector_results):
+        with stage("lexical_search"):
+            lexical_ids, _ = lexical.search(question, depth, allowed)
+        results.append(reciprocal_rank_fusion([vector_ids.tolist(), lexical_ids.tolist()], top_k))
+    return results
+
+async def filter_chunk_ids_async(chunk_filter: Optional[ChunkFilter], db: AsyncSession, user_id: int):
+    """Sorted ids of the chunks in the user's live files matching the filter,
+    or None without a filter. Reads file_chunks by its (file_id, position)
+    key, so the cost follows the size of the matching files."""
+    if chunk_filter is None:
+        return None
+    files = select(UploadedFile.id).where(UploadedFile.user_id == user_id, UploadedFile.deleted_at.is_(None))
+    if chunk_filter.file_ids is not None:
+        files = files.where(UploadedFile.id.in_(chunk_filter.file_ids))
+    if chunk_filter.filename:
+        files = files.where(UploadedFile.filename.ilike(glob_to_like(chunk_filter.filename), escape="\\"))
+    if chunk_filter.uploaded_after is not None:
+        files = files.where(UploadedFile.upload_date >= _local_time(chunk_filter.uploaded_after))
+    if chunk_filter.uploaded_before is not None:
+        files = files.where(UploadedFile.upload_date < _local_time(chunk_filter.uploaded_before))
+    with stage("filter"):
+        result = await db.execute(select(FileChunk.chunk_id).where(FileChunk.file_id.in_(files)))
+        return np.unique(np.fromiter(result.scalars(), dtype=np.int64))
+
+def retrieve(query, db: Session, user_id: int, top_k=DEFAULT_TOP_K):
+    ids = search_chunk_ids(query, user_id, top_k)
+    if not ids:
         return []
 
-    docs_with_scores = []
-    for chunk in db_chunks:
-        embedding = np.frombuffer(chunk.embedding, dtype='float32')
-        dist = np.linalg.norm(embedding - q)
-        docs_with_scores.append((chunk.content, dist))
-    
-    docs_with_scores.sort(key=lambda x: x[1])
-    return [doc for doc, score in docs_with_scores[:top_k]]
-
-def generate_answer(query, db: Session, user_id: int):
-    docs = retrieve(query, db, user_id)
-    if not docs:
-        return "No documents found in your history. Please upload a PDF."
-    
-    if USE_MOCK:
-        return f"Answer based on your history: {', '.join(docs)}"
-    return f"(LLM) Answer based on: {', '.join(docs)}"
+    # Fetch only the contents of the winning chunks
+    rows = (db.query(DocumentChunk.id, DocumentChunk.content)
+            .filter(DocumentChunk.id.in_(ids), DocumentChunk.user_id == user_id).all())
+    contents = dict(rows)
+    return [contents[i] for i in ids if i in contents]
 
-def process_and_save_pdf_text(text, filename, db: Session, user_id: int):
-    # 1. Record the file
-    new_file = UploadedFile(
-        filename=filename, 
-        upload_date=datetime.now().strftime("%Y-%m-%d %H:%M"),
-        user_id=user_id
-    )
-    db.add(new_file)
-    db.commit()
-    db.refresh(new_file)
-    
-    # 2. Save chunks linked to this file
-    chunks = chunk_text(text)
-    for chunk in chunks:
-        emb = get_embedding(chunk)
-        embedding_bytes = emb.tobytes()
-        db_chunk = DocumentChunk(
-            content=chunk, 
-            embedding=embedding_bytes, 
-            user_id=user_id,
-            file_id=new_file.id
+async def fetch_contents_async(ids, db: AsyncSession, user_id: int):
+    # Scoped to the user: ids come from the index, never trust them across tenants
+    if not ids:
+        return []
+
+    with stage("db_fetch"):
+        result = await db.execute(select(DocumentChunk.id, DocumentChunk.content)
+                                  .where(DocumentChunk.id.in_(ids), DocumentChunk.user_id == user_id))
+        contents = dict(result.all())
+    count("bytes_read", sum(len(c) for c in contents.values()))
+    return [contents[i] for i in ids if i in contents]
+
+async def fetch_sources_async(ids, db: AsyncSession, user_id: int):
+    # Chunks with the file they came from, in ranking order
+    if not ids:
+        return []
+
+    with stage("db_fetch"):
+        result = await db.execute(
+            select(DocumentChunk.id, DocumentChunk.content, DocumentChunk.file_id, UploadedFile.filename)
+            .join(UploadedFile, UploadedFile.id == DocumentChunk.file_id)
+            .where(DocumentChunk.id.in_(ids), DocumentChunk.user_id == user_id)
+        )
+        rows = {row.id: row for row in result.all()}
+    count("bytes_read", sum(len(row.content) for row in rows.values()))
+    return [rows[i] for i in ids if i in rows]
+
+def source_to_dict(source):
+    return {"chunk_id": source.id, "file_id": source.file_id, "filename": source.filename,
+            "preview": source.content[:200]}
+
+async def retrieve_async(query, db: AsyncSession, user_id: int, top_k=DEFAULT_TOP_K, chunk_filter=None):
+    allowed = await filter_chunk_ids_async(chunk_filter, db, user_id)
+    ids = await asyncio.to_thread(search_chunk_ids, query, user_id, top_k, allowed)
+    return await fetch_contents_async(ids, db, user_id)
+
+def build_answer(docs, question=""):
+    with stage("generate"):
+        return "".join(generator.generate(question, docs))
+
+def generate_answer(query, db: Session, user_id: int, top_k=DEFAULT_TOP_K):
+    return build_answer(retrieve(query, db, user_id, top_k), query)
+
+async def generate_answer_async(query, db: AsyncSession, user_id: int, top_k=DEFAULT_TOP_K, chunk_filter=None):
+    # Repeated questions are answered from the query cache until the user's
+    # documents change
+    question = normalize_question(query)
+    cache_key = query_cache_key(question, top_k, chunk_filter)
+    epoch = query_cache.epoch(user_id)
+    version = await get_index_version(db, user_id)
+    cached = query_cache.get(user_id, version, cache_key)
+    if cached is not None:
+        count("query_cache_hits")
+        return cached.answer
+    count("query_cache_misses")
+
+    allowed = await filter_chunk_ids_async(chunk_filter, db, user_id)
+    ids = await asyncio.to_thread(search_chunk_ids, question, user_id, top_k, allowed)
+    answer = await asyncio.to_thread(build_answer, await fetch_contents_async(ids, db, user_id), question)
+    query_cache.put(user_id, version, cache_key, CachedAnswer(tuple(ids), answer), epoch)
+    return answer
+
+async def stream_answer_async(query, db: AsyncSession, user_id: int, top_k=DEFAULT_TOP_K, chunk_filter=None):
+    """Retrieve, then return an async iterator of (event, data) pairs:
+    one "sources" event, "token" events as the generator produces them, and
+    a final "done" event with time-to-first-token and total latency.
+
+    All database work happens before this returns, so the iterator can be
+    consumed after the request's session is closed.
+    """
+    start = time.perf_counter()
+    question = normalize_question(query)
+    cache_key = query_cache_key(question, top_k, chunk_filter)
+    epoch = query_cache.epoch(user_id)
+    version = await get_index_version(db, user_id)
+    cached = query_cache.get(user_id, version, cache_key)
+    count("query_cache_hits" if cached is not None else "query_cache_misses")
+    if cached is not None:
+        ids = list(cached.chunk_ids)
+    else:
+        allowed = await filter_chunk_ids_async(chunk_filter, db, user_id)
+        ids = await asyncio.to_thread(search_chunk_ids, question, user_id, top_k, allowed)
+    sources = await fetch_sources_async(ids, db, user_id)
+    retrieval_ms = (time.perf_counter() - start) * 1000
+
+    async def events():
+        yield "sources", [source_to_dict(s) for s in sources]
+        first_token_ms = None
+        if cached is not None:
+            pieces = [cached.answer]
+            first_token_ms = (time.perf_counter() - start) * 1000
+            yield "token", {"text": cached.answer}
+        else:
+            pieces = []
+            docs = [s.content for s in sources]
+            # Generators may block (model calls), keep them off the event loop
+            async for token in iterate_in_threadpool(generator.generate(question, docs)):
+                if first_token_ms is None:
+                    first_token_ms = (time.perf_counter() - start) * 1000
+                pieces.append(token)
+                yield "token", {"text": token}
+            query_cache.put(user_id, version, cache_key, CachedAnswer(tuple(ids), "".join(pieces)), epoch)
+        yield "done", {
+            "cached": cached is not None,
+            "retrieval_ms": round(retrieval_ms, 2),
+            "ttft_ms": round(first_token_ms, 2) if first_token_ms is not None else None,
+            "total_ms": round((time.perf_counter() - start) * 1000, 2),
+        }
+
+    return events()
+
+async def answer_batch_async(questions, db: AsyncSession, user_id: int, top_k=DEFAULT_TOP_K, chunk_filter=None):
+    """Yield {"index", "question", "answer", "sources"} for each question, in
+    order, retrieving QUERY_BATCH_SIZE questions at a time."""
+    epoch = query_cache.epoch(user_id)
+    version = await get_index_version(db, user_id)
+    # Resolved once, on the first slice with a cache miss
+    allowed = None
+    for start in range(0, len(questions), QUERY_BATCH_SIZE):
+        part = questions[start:start + QUERY_BATCH_SIZE]
+        normalized = [normalize_question(q) for q in part]
+        keys = [query_cache_key(q, top_k, chunk_filter) for q in normalized]
+        cached = [query_cache.get(user_id, version, key) for key in keys]
+        hits = sum(c is not None for c in cached)
+        count("query_cache_hits", hits)
+        count("query_cache_misses", len(cached) - hits)
+
+        # Repeated questions are retrieved once
+        missing = list(dict.fromkeys(q for q, c in zip(normalized, cached) if c is None))
+        found = {}
+        if missing:
+            if chunk_filter is not None and allowed is None:
+                allowed = await filter_chunk_ids_async(chunk_filter, db, user_id)
+            found = dict(zip(missing, await asyncio.to_thread(search_chunk_ids_batch, missing, user_id, top_k, allowed)))
+        ids_per_question = [list(c.chunk_ids) if c is not None else found[q] for q, c in zip(normalized, cached)]
+
+        # One round trip for the sources of the whole slice
+        wanted = list(dict.fromkeys(chain.from_iterable(ids_per_question)))
+        sources = {row.id: row for row in await fetch_sources_async(wanted, db, user_id)}
+        sources_per_question = [[sources[i] for i in ids if i in sources] for ids in ids_per_question]
+
+        def answer_all():
+            return [c.answer if c is not None else build_answer([r.content for r in rows], q)
+                    for q, c, rows in zip(normalized, cached, sources_per_question)]
+
+        answers = await asyncio.to_thread(answer_all)
+        for i, question in enumerate(part):
+            if cached[i] is None:
+                query_cache.put(user_id, version, keys[i],
+                                CachedAnswer(tuple(ids_per_question[i]), answers[i]), epoch)
+            yield {
+                "index": start + i,
+                "question": question,
+                "answer": answers[i],
+                "sources": [source_to_dict(r) for r in sources_per_question[i]],
+            }
+
+class EmptyDocument(ValueError):
+    pass
+
+def timed(iterable, timings, stage):
+    # Accumulates the time spent producing each item under timings[stage]
+    it = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            timings[stage] += time.perf_counter() - start
+            return
+        timings[stage] += time.perf_counter() - start
+        yield item
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def require_text(pages):
+    # Hold pages back until one with text shows up, so empty PDFs are
+    # rejected before the first chunk (and the file record) is written
+    pages = iter(pages)
+    seen = []
+    for page in pages:
+        seen.append(page)
+        if page.strip():
+            yield from seen
+            yield from pages
+            return
+    raise EmptyDocument("PDF is empty.")
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def embed_missing(contents, known, vectors, timings):
+    # Adds to `vectors` ({hash: vector}) the content in neither `known` nor `vectors`
+    missing = [h for h in contents if h not in known and h not in vectors]
+    if missing:
+        start = time.perf_counter()
+        vectors.update(zip(missing, embedder.embed_batch([contents[h] for h in missing])))
+        timings["embed"] += time.perf_counter() - start
+
+def save_chunk_batch(chunks, file_id, position, db: Session, user_id: int, timings, progress=None, new_file=None):
+    # Content the user already stores is only referenced from the file;
+    # just the new chunks are embedded, inserted and indexed. With
+    # `new_file` (an UploadedFile not added yet) the file is recorded here.
+    start = time.perf_counter()
+    hashes = [chunk_hash(c) for c in chunks]
+    contents = dict(zip(hashes, chunks))
+    known = chunk_ids_by_hash(db, user_id, set(hashes))
+    timings["dedup"] += time.perf_counter() - start
+    # Before the write transaction starts, so it is not held while embedding
+    vectors = {}
+    embed_missing(contents, known, vectors, timings)
+
+    if new_file is not None:
+        # The first write of the transaction
+        db.add(new_file)
+        db.flush()
+        file_id = new_file.id
+
+    revived = []
+    if known:
+        start = time.perf_counter()
+        # Content of a deleted document that has not been compacted away yet
+        revived = revive_chunks(db, user_id, set(known.values()), file_id)
+        # Inside the write transaction now, where compaction can no longer
+        # purge them: look the chunks up again, as one purged since the first
+        # lookup had no tombstone left to revive and must be stored anew
+        known = chunk_ids_by_hash(db, user_id, set(known))
+        timings["dedup"] += time.perf_counter() - start
+        embed_missing(contents, known, vectors, timings)
+
+    new_hashes = [h for h in contents if h not in known]
+    new_ids, new_chunks, embeddings = [], [], None
+    if new_hashes:
+        start = time.perf_counter()
+        inserted = insert_unique_chunks(db, [contents[h] for h in new_hashes], new_hashes, user_id, file_id)
+        if len(inserted) < len(new_hashes):
+            # A concurrent upload of the same user stored some of them first
+            known.update(chunk_ids_by_hash(db, user_id, set(new_hashes) - set(inserted)))
+        new_hashes = [h for h in new_hashes if h in inserted]
+        new_ids = [inserted[h] for h in new_hashes]
+        new_chunks = [contents[h] for h in new_hashes]
+        embeddings = np.array([vectors[h] for h in new_hashes], dtype=np.float32) if new_hashes else None
+        known.update(inserted)
+        timings["persist"] += time.perf_counter() - start
+
+    start = time.perf_counter()
+    insert_file_chunks(db, file_id, position, [known[h] for h in hashes])
+    # Every chunk that did not add a row saved its content, vector and id
+    row_bytes = embedding_store.dim * 4 + 8
+    bytes_saved = (sum(len(c.encode("utf-8")) for c in chunks) - sum(len(c.encode("utf-8")) for c in new_chunks)
+                   + row_bytes * (len(chunks) - len(new_ids)))
+    if progress:
+        # Lets callers (the job queue) record progress in the same transaction
+        progress(db, file_id, len(chunks), len(new_ids), bytes_saved)
+    version = bump_index_version(db, user_id)
+    # Vectors go to the user's on-disk segment, SQL keeps only the content.
+    # They are written once the commit succeeded: rows of a rolled-back batch
+    # would carry ids the database later hands to another user's chunks.
+    embedding_store.append(user_id, new_ids, embeddings if new_ids else [], commit=db.commit)
+    timings["persist"] += time.perf_counter() - start
+
+    # Make the new chunks visible to the user's loaded index, then drop
+    # answers computed without them
+    if new_ids:
+        user_indexes.add(user_id, new_ids, embeddings)
+        lexical_indexes.add(user_id, new_ids, new_chunks)
+    if revived:
+        user_indexes.undelete(user_id, revived)
+        lexical_indexes.undelete(user_id, revived)
+    # Already applied here; other processes reload when they see the version
+    user_indexes.advance(user_id, version)
+    lexical_indexes.advance(user_id, version)
+    query_cache.invalidate(user_id)
+    return len(new_ids), bytes_saved
+
+def ingest_chunks(chunks, filename, db: Session, user_id: int, timings=None,
+                  batch_size=INGEST_BATCH_SIZE, file_id=None, progress=None, start_position=0):
+    timings = timings if timings is not None else defaultdict(float)
+
+    # 1. The file, unless resuming into an existing one, is recorded with the
+    # first batch once that is embedded: a failing source (e.g. an empty PDF)
+    # leaves no file behind, and the write lock is not held while embedding
+    new_file = None
+    if file_id is None:
+        new_file = UploadedFile(
+            filename=filename, 
+            upload_date=datetime.now(),
+            user_id=user_id
         )
-        db.add(db_chunk)
+
+    # 2. Embed and save chunks in bounded batches as they are produced
+    chunks_done = new_count = bytes_saved = 0
+    for batch in batched(chunks, batch_size):
+        new, saved = save_chunk_batch(batch, file_id, start_position + chunks_done, db, user_id, timings, progress,
+                                      new_file=new_file)
+        if new_file is not None:
+            file_id, new_file = new_file.id, None
+        chunks_done += len(batch)
+        new_count += new
+        bytes_saved += saved
+    if new_file is not None:
+        # No chunks at all
+        db.add(new_file)
+        db.flush()
+        file_id = new_file.id
     db.commit()
-    return len(chunks)
+    return {
+        "file_id": file_id,
+        "chunks": chunks_done,
+        "new_chunks": new_count,
+        "dedup_ratio": round(1 - new_count / chunks_done, 4) if chunks_done else 0.0,
+        "bytes_saved": bytes_saved,
+        "timings": timings,
+    }
+
+def ingest_pages(pages, filename, db: Session, user_id: int, skip_chunks=0, file_id=None, progress=None):
+    timings = defaultdict(float)
+    counter = {"pages": 0}
+
+    def counted(pages):
+        for page in pages:
+            counter["pages"] += 1
+            yield page
+
+    def report(db, file_id, n, new, saved):
+        progress(db, file_id, n, new, saved, counter["pages"])
+
+    pages = require_text(counted(timed(pages, timings, "extract")))
+    # Chunking is deterministic, so a resumed ingest skips what was committed
+    chunks = islice(timed(iter_chunks(pages), timings, "chunk"), skip_chunks, None)
+    result = ingest_chunks(chunks, filename, db, user_id, timings, file_id=file_id,
+                           progress=report if progress else None, start_position=skip_chunks)
+    # Chunk time includes waiting on extraction, which is reported on its own
+    timings["chunk"] -= timings["extract"]
+    result["pages"] = counter["pages"]
+    for name, seconds in timings.items():
+        record_stage(f"ingest_{name}", seconds)
+    count("chunks_ingested", result["chunks"])
+    result["timings"] = {stage: round(seconds * 1000, 1) for stage, seconds in timings.items()}
+    return result
+
+def process_and_save_pdf_text(text, filename, db: Session, user_id: int):
+    return ingest_chunks(iter_chunks([text]), filename, db, user_id)["chunks"]
@@ -0,0 +1,40 @@
+"""Production entry point: several uvicorn worker processes, no reload.
+
+    python serve.py --workers 4 --port 8000 --warm 100
+
+Each worker keeps its own index and answer caches. They stay consistent
+through the index_versions table (see index_sync.py); set QUERY_CACHE_PATH
+so cached answers are shared between workers as well. The database schema
+is created here once, before the workers start.
+"""
+import argparse
+import os
+
+import uvicorn
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=os.getenv("HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1))))
+    parser.add_argument("--warm", default=os.getenv("INDEX_WARM_USERS", "100"),
+                        help='Most recently active users whose indexes each worker loads at startup, or "all"')
+    parser.add_argument("--sync-interval", type=float, default=float(os.getenv("INDEX_SYNC_INTERVAL_SECONDS", "1")),
+                        help="Seconds until an upload through one worker reaches the others")
+    args = parser.parse_args()
+
+    # Workers are spawned processes: they read their settings from the environment
+    os.environ["INDEX_WARM_USERS"] = str(args.warm)
+    os.environ["INDEX_SYNC_INTERVAL_SECONDS"] = str(args.sync_interval)
+
+    # Concurrent create_all / migrations from every worker would race
+    from database import init_db
+    init_db()
+    os.environ["INIT_DB_ON_STARTUP"] = "0"
+
+    uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers, reload=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+
+def authenticate(token):
+    from auth import get_current_user
+    from database import AsyncSessionLocal
+
+    async def run():
+        async with AsyncSessionLocal() as db:
+            return await get_current_user(token, db)
+
+    return asyncio.run(run())
+
+
+def execute(statement):
+    # Core statements skip the ORM events, like a write in another process
+    from database import engine
+
+    with engine.begin() as conn:
+        conn.execute(statement)
+
+
+def test_tokens_of_users_changed_elsewhere_are_dropped(user_id):
+    from sqlalchemy import delete, update
+    from auth import create_access_token, sync_token_cache, token_cache
+    from database import User
+
+    token = create_access_token({"sub": f"user-{user_id}"})
+    assert authenticate(token).id == user_id
+    assert sync_token_cache() == 0
+    assert token_cache.get(token) is not None
+
+    execute(update(User).where(User.id == user_id).values(hashed_password="y"))
+    assert sync_token_cache() == 1
+    assert authenticate(token).id == user_id
+
+    execute(delete(User).where(User.id == user_id))
+    # Still cached until the next sync
+    assert authenticate(token).id == user_id
+    sync_token_cache()
+    with pytest.raises(HTTPException):
+        authenticate(token)
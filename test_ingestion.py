@@ -0,0 +1,171 @@
+import asyncio
+import threading
+
+import pytest
+
+
+def ingest(texts, filename, user_id, **kwargs):
+    from database import WriteSessionLocal
+    from rag import ingest_chunks
+
+    db = WriteSessionLocal()
+    try:
+        return ingest_chunks(iter(texts), filename, db, user_id, **kwargs)
+    finally:
+        db.close()
+
+
+def delete(user_id, file_id):
+    from compaction import delete_document_async
+    from database import AsyncSessionLocal
+
+    async def run():
+        async with AsyncSessionLocal() as db:
+            return await delete_document_async(db, user_id, file_id)
+
+    return asyncio.run(run())
+
+
+def test_reupload_stores_nothing_new(user_id):
+    from embedding_store import embedding_store
+
+    texts = [f"unique chunk {i}" for i in range(20)]
+    first = ingest(texts, "a.pdf", user_id)
+    assert (first["chunks"], first["new_chunks"], first["dedup_ratio"]) == (20, 20, 0.0)
+
+    again = ingest(texts, "a-copy.pdf", user_id)
+    assert (again["chunks"], again["new_chunks"], again["dedup_ratio"]) == (20, 0, 1.0)
+    assert again["bytes_saved"] > 20 * embedding_store.dim * 4
+    assert again["file_id"] != first["file_id"]
+    assert embedding_store.count(user_id) == 20
+
+
+def test_partial_overlap_ratio(user_id):
+    ingest([f"shared {i}" for i in range(30)], "a.pdf", user_id, batch_size=8)
+    result = ingest([f"shared {i}" for i in range(10, 30)] + [f"fresh {i}" for i in range(20)], "b.pdf", user_id,
+                    batch_size=8)
+    assert (result["chunks"], result["new_chunks"], result["dedup_ratio"]) == (40, 20, 0.5)
+
+
+def test_repeated_chunks_within_a_file_keep_their_positions(user_id):
+    from database import FileChunk, SessionLocal
+
+    texts = ["same", "other", "same", "same"]
+    result = ingest(texts, "a.pdf", user_id, batch_size=3)
+    assert result["new_chunks"] == 2
+    db = SessionLocal()
+    try:
+        rows = db.query(FileChunk.position, FileChunk.chunk_id).filter(
+            FileChunk.file_id == result["file_id"]).order_by(FileChunk.position).all()
+    finally:
+        db.close()
+    assert [position for position, _ in rows] == [0, 1, 2, 3]
+    assert rows[0].chunk_id == rows[2].chunk_id == rows[3].chunk_id != rows[1].chunk_id
+
+
+def test_delete_compact_and_revive(user_id):
+    from compaction import compact_user
+    from database import tombstoned_chunk_ids, user_chunk_ids
+    from embedding_store import embedding_store
+
+    keep = ingest([f"keep {i}" for i in range(10)], "keep.pdf", user_id)
+    gone = ingest([f"gone {i}" for i in range(15)] + [f"keep {i}" for i in range(5)], "gone.pdf", user_id)
+
+    # Chunks the other file still references stay live
+    assert delete(user_id, gone["file_id"]) == 15
+    assert len(tombstoned_chunk_ids(user_id)) == 15
+    assert delete(user_id, gone["file_id"]) is None
+
+    # Uploading the content again before compaction revives the rows
+    revived = ingest([f"gone {i}" for i in range(5)], "again.pdf", user_id)
+    assert revived["new_chunks"] == 0
+    assert len(tombstoned_chunk_ids(user_id)) == 10
+
+    stats = compact_user(user_id)
+    assert stats["chunks_purged"] == 10
+    assert (stats["rows_before"], stats["rows_after"]) == (25, 15)
+    assert embedding_store.count(user_id) == 15
+    assert tombstoned_chunk_ids(user_id) == []
+    ids, _ = embedding_store.load(user_id)
+    assert sorted(ids.tolist()) == sorted(user_chunk_ids(user_id))
+
+    # Purged content is stored anew
+    assert ingest([f"gone {i}" for i in range(10, 15)], "last.pdf", user_id)["new_chunks"] == 5
+    assert keep["new_chunks"] == 10
+
+
+class StopAfter:
+    """Stop event that is set once checked ``n`` times, i.e. after ``n`` batches."""
+
+    def __init__(self, n):
+        self.checks = 0
+        self.n = n
+
+    def is_set(self):
+        self.checks += 1
+        return self.checks > self.n
+
+
+def test_interrupted_job_resumes_where_it_stopped(user_id, tmp_path, monkeypatch):
+    from datetime import datetime
+    import jobs
+    from database import DocumentChunk, FileChunk, IngestJob, SessionLocal, WriteSessionLocal
+    from embedding_store import embedding_store
+    from rag import INGEST_BATCH_SIZE, iter_chunks
+
+    pages = [" ".join(f"page{p}-word{w}" for w in range(1500)) for p in range(12)]
+    expected = list(iter_chunks(pages))
+    assert len(expected) > 2 * INGEST_BATCH_SIZE
+    monkeypatch.setattr(jobs, "iter_pages", lambda path, num_pages=None: iter(pages))
+    path = tmp_path / "upload.pdf"
+    path.write_bytes(b"")
+
+    db = WriteSessionLocal()
+    try:
+        job = IngestJob(user_id=user_id, filename="big.pdf", path=str(path), state="running",
+                        pages_total=len(pages), created_at=datetime.utcnow())
+        db.add(job)
+        db.commit()
+        job_id = job.id
+    finally:
+        db.close()
+
+    jobs.run_job(job_id, StopAfter(1))
+    db = SessionLocal()
+    try:
+        job = db.get(IngestJob, job_id)
+        assert (job.state, job.chunks_done) == ("queued", INGEST_BATCH_SIZE)
+        assert path.exists()
+    finally:
+        db.close()
+
+    jobs.run_job(job_id, threading.Event())
+    db = SessionLocal()
+    try:
+        job = db.get(IngestJob, job_id)
+        assert (job.state, job.error) == ("done", None)
+        assert job.chunks_done == job.chunks_new == len(expected)
+        rows = (db.query(FileChunk.position, DocumentChunk.content)
+                .join(DocumentChunk, DocumentChunk.id == FileChunk.chunk_id)
+                .filter(FileChunk.file_id == job.file_id).order_by(FileChunk.position).all())
+        assert [position for position, _ in rows] == list(range(len(expected)))
+        assert [content for _, content in rows] == expected
+    finally:
+        db.close()
+    assert not path.exists()
+    ids, _ = embedding_store.load(user_id)
+    assert len(ids) == len(set(ids.tolist())) == len(expected)
+
+
+def test_empty_upload_leaves_no_file(user_id):
+    from database import SessionLocal, UploadedFile
+    from rag import EmptyDocument, ingest_pages
+
+    db = SessionLocal()
+    try:
+        with pytest.raises(EmptyDocument):
+            ingest_pages(["", "  "], "empty.pdf", db, user_id)
+        db.rollback()
+        assert db.query(UploadedFile).filter(UploadedFile.user_id == user_id).count() == 0
+    finally:
+        db.close()
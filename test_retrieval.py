@@ -0,0 +1,149 @@
+import asyncio
+from datetime import datetime, timedelta
+
+
+def ingest(texts, filename, user_id):
+    from database import WriteSessionLocal
+    from rag import ingest_chunks
+
+    db = WriteSessionLocal()
+    try:
+        return ingest_chunks(iter(texts), filename, db, user_id)
+    finally:
+        db.close()
+
+
+def run(query):
+    from database import AsyncSessionLocal
+
+    async def session():
+        async with AsyncSessionLocal() as db:
+            return await query(db)
+
+    return asyncio.run(session())
+
+
+def filtered_ids(user_id, chunk_filter):
+    from rag import filter_chunk_ids_async
+
+    return run(lambda db: filter_chunk_ids_async(chunk_filter, db, user_id)).tolist()
+
+
+def file_chunk_ids(file_id):
+    from database import FileChunk, SessionLocal
+
+    db = SessionLocal()
+    try:
+        return sorted(chunk_id for chunk_id, in db.query(FileChunk.chunk_id).filter(FileChunk.file_id == file_id))
+    finally:
+        db.close()
+
+
+def test_filters(user_id):
+    from database import SessionLocal, UploadedFile
+    from rag import ChunkFilter
+
+    report = ingest([f"report {i}" for i in range(5)], "Q3_Report.pdf", user_id)
+    notes = ingest([f"notes {i}" for i in range(3)], "notes.pdf", user_id)
+    old = ingest([f"old {i}" for i in range(4)], "q3_report_2019.pdf", user_id)
+    db = SessionLocal()
+    try:
+        db.get(UploadedFile, old["file_id"]).upload_date = datetime(2019, 6, 1)
+        db.commit()
+    finally:
+        db.close()
+
+    assert filtered_ids(user_id, ChunkFilter(filename="q3*")) == sorted(
+        file_chunk_ids(report["file_id"]) + file_chunk_ids(old["file_id"]))
+    # `_` is literal, not a LIKE wildcard
+    assert filtered_ids(user_id, ChunkFilter(filename="q3_report.pdf")) == file_chunk_ids(report["file_id"])
+    assert filtered_ids(user_id, ChunkFilter(file_ids=(notes["file_id"],))) == file_chunk_ids(notes["file_id"])
+    assert filtered_ids(user_id, ChunkFilter(uploaded_before=datetime(2020, 1, 1))) == file_chunk_ids(old["file_id"])
+    after = datetime.now() - timedelta(days=1)
+    assert filtered_ids(user_id, ChunkFilter(filename="*.pdf", uploaded_after=after)) == sorted(
+        file_chunk_ids(report["file_id"]) + file_chunk_ids(notes["file_id"]))
+    # Conditions combine; another user's file ids match nothing
+    assert filtered_ids(user_id, ChunkFilter(file_ids=(notes["file_id"],), filename="q3*")) == []
+    assert filtered_ids(user_id + 1, ChunkFilter(file_ids=(notes["file_id"],))) == []
+
+
+def test_filtered_search_stays_inside_the_filter(user_id):
+    from rag import ChunkFilter, retrieve_async
+
+    ingest([f"alpha topic {i}" for i in range(10)], "alpha.pdf", user_id)
+    beta = ingest([f"beta topic {i}" for i in range(10)], "beta.pdf", user_id)
+    docs = run(lambda db: retrieve_async("alpha topic 3", db, user_id, top_k=5,
+                                         chunk_filter=ChunkFilter(file_ids=(beta["file_id"],))))
+    assert len(docs) == 5
+    assert all(doc.startswith("beta") for doc in docs)
+
+
+def test_query_cache_is_invalidated_by_uploads(user_id):
+    from database import get_index_version
+    from rag import generate_answer_async, query_cache, query_cache_key
+
+    ingest(["the sky is blue"], "sky.pdf", user_id)
+    ask = lambda db: generate_answer_async("What colour is the sky?", db, user_id, top_k=10)
+    first = run(ask)
+    version = run(lambda db: get_index_version(db, user_id))
+    key = query_cache_key("what colour is the sky?", 10)
+    assert query_cache.get(user_id, version, key).answer == first
+    assert run(ask) == first
+
+    ingest(["the sky is green at dusk"], "dusk.pdf", user_id)
+    assert query_cache.get(user_id, version, key) is None
+    second = run(ask)
+    assert second != first and "green" in second
+
+
+def test_disk_cache_invalidation_reaches_other_workers(tmp_path):
+    from query_cache import CachedAnswer, QueryCache
+
+    path = str(tmp_path / "cache.db")
+    mine, theirs = QueryCache(path=path), QueryCache(path=path)
+    mine.put(1, 4, "q", CachedAnswer((1, 2), "answer"))
+    mine.put(2, 4, "q", CachedAnswer((3,), "other user"))
+    assert theirs.get(1, 4, "q").answer == "answer"
+    # A newer version never serves the stale answer
+    assert theirs.get(1, 5, "q") is None
+
+    theirs.memory.clear()
+    mine.invalidate(1)
+    assert theirs.get(1, 4, "q") is None
+    assert theirs.get(2, 4, "q").answer == "other user"
+
+
+def test_other_workers_catch_up_and_reload(user_id):
+    from compaction import compact_user, delete_document_async
+    from database import index_versions
+    from rag import embedder
+    from vector_index import IndexCache
+
+    first = ingest([f"first {i}" for i in range(10)], "first.pdf", user_id)
+    # Another worker process's cache: sees changes only through index_versions
+    other = IndexCache(1 << 30)
+    index = other.get(user_id)
+    assert len(index.chunk_ids()) == 10
+
+    ingest([f"second {i}" for i in range(10)], "second.pdf", user_id)
+    assert other.refresh(index_versions([user_id])) == [user_id]
+    assert other.get(user_id) is index
+    chunk_ids = index.chunk_ids()
+    assert len(chunk_ids) == len(set(chunk_ids.tolist())) == 20
+    assert other.refresh(index_versions([user_id])) == []
+
+    dead = file_chunk_ids(first["file_id"])
+    assert run(lambda db: delete_document_async(db, user_id, first["file_id"])) == 10
+    other.refresh(index_versions([user_id]))
+    assert other.get(user_id) is index
+    found, _ = index.search(embedder.embed_batch(["first 3"])[0], 20)
+    assert len(found) == 10 and not set(found.tolist()) & set(dead)
+
+    compact_user(user_id)
+    other.refresh(index_versions([user_id]))
+    assert user_id not in other.users()
+    reloaded = other.get(user_id)
+    assert reloaded is not index
+    assert sorted(reloaded.chunk_ids().tolist()) == sorted(set(chunk_ids.tolist()) - set(dead))
+    found, _ = reloaded.search(embedder.embed_batch(["first 3"])[0], 20)
+    assert len(found) == 10
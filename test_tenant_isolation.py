@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+
+def test_interrupted_batch_does_not_leak_into_other_users():
+    from database import AsyncSessionLocal, WriteSessionLocal
+    from embedding_store import embedding_store
+    from jobs import JobInterrupted
+    from rag import generate_answer_async, ingest_chunks
+
+    def interrupt(*args):
+        # What the job queue does to a batch when the server shuts down
+        raise JobInterrupted()
+
+    db = WriteSessionLocal()
+    try:
+        with pytest.raises(JobInterrupted):
+            ingest_chunks(["ALICE notes one", "ALICE notes two"], "alice.pdf", db, 1, progress=interrupt)
+        db.rollback()
+        # SQLite hands the rolled-back chunk ids out again
+        ingest_chunks(["BOB PRIVATE medical", "BOB PRIVATE salary data"], "bob.pdf", db, 2)
+    finally:
+        db.close()
+
+    assert embedding_store.count(1) == 0
+
+    async def ask():
+        async with AsyncSessionLocal() as session:
+            return await generate_answer_async("medical salary", session, user_id=1)
+
+    assert "BOB" not in asyncio.run(ask())
+
+
+def test_compaction_drops_rows_without_a_chunk():
+    import numpy as np
+    from compaction import compact_user
+    from embedding_store import embedding_store
+
+    # Left in a segment by a rolled-back batch before appends waited for the commit
+    embedding_store.append(3, [999], np.ones((1, embedding_store.dim)))
+    compact_user(3)
+    assert embedding_store.count(3) == 0
+
+
+def test_compaction_keeps_the_last_row_of_a_reused_id(user_id):
+    import numpy as np
+    from embedding_store import embedding_store
+
+    # A rolled-back batch's row, then the committed row that reused its id
+    stale, live = np.zeros((1, embedding_store.dim)), np.ones((1, embedding_store.dim))
+    embedding_store.append(user_id, [7], stale)
+    embedding_store.append(user_id, [7], live)
+    assert embedding_store.compact(user_id, lambda: [7]) == (2, 1)
+    ids, matrix = embedding_store.load(user_id)
+    assert ids.tolist() == [7]
+    np.testing.assert_array_equal(matrix, live)
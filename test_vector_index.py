@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+
+from quantization import Float16Codec, Int8Codec, PQCodec
+from vector_index import ExactIndex, IVFIndex, IndexCache, QuantizedIndex
+
+DIM = 32
+TOP_K = 10
+
+
+@pytest.fixture(scope="module")
+def data():
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal((2000, DIM)).astype(np.float32)
+    # Chunk ids are not row numbers
+    ids = np.arange(1, len(x) + 1, dtype=np.int64) * 3
+    queries = rng.standard_normal((5, DIM)).astype(np.float32)
+    return ids, x, queries
+
+
+def brute_force(ids, x, q, top_k):
+    d = ((x - q) ** 2).sum(axis=1)
+    order = np.lexsort((np.arange(len(d)), d))[:top_k]
+    return ids[order], np.sqrt(d[order])
+
+
+def make_index(kind, ids, x):
+    if kind == "exact":
+        # Base segment plus an in-memory tail, as after an upload
+        index = ExactIndex(ids[:1500], x[:1500])
+        index.add(ids[1500:], x[1500:])
+        return index
+    if kind == "ivf":
+        # Probing every list is exhaustive
+        index = IVFIndex(nlist=8, nprobe=8)
+        index.add(ids, x)
+        assert index._trained is not None
+        return index
+    codec = {"float16": Float16Codec, "int8": Int8Codec, "pq": lambda: PQCodec(subvectors=8)}[kind]()
+    return QuantizedIndex(codec, ids, x, rerank=200)
+
+
+@pytest.mark.parametrize("kind", ["exact", "ivf", "float16", "int8"])
+def test_top_k_matches_brute_force(data, kind):
+    ids, x, queries = data
+    index = make_index(kind, ids, x)
+    assert index.size == len(ids)
+    for q in queries:
+        found, dists = index.search(q, TOP_K)
+        expected, expected_dists = brute_force(ids, x, q, TOP_K)
+        np.testing.assert_array_equal(found, expected)
+        np.testing.assert_allclose(dists, expected_dists, rtol=1e-4)
+
+
+def test_pq_rerank_returns_exact_distances(data):
+    ids, x, queries = data
+    index = make_index("pq", ids, x)
+    rows = {chunk_id: row for row, chunk_id in enumerate(ids)}
+    recall = []
+    for q in queries:
+        found, dists = index.search(q, TOP_K)
+        expected, _ = brute_force(ids, x, q, TOP_K)
+        recall.append(len(set(found.tolist()) & set(expected.tolist())) / TOP_K)
+        # Re-ranked from the float32 rows
+        true = np.sqrt(((x[[rows[i] for i in found]] - q) ** 2).sum(axis=1))
+        np.testing.assert_allclose(dists, true, rtol=1e-4)
+        assert (np.diff(dists) >= 0).all()
+    assert np.mean(recall) >= 0.9
+
+
+def test_batch_search_matches_single(data):
+    ids, x, queries = data
+    index = make_index("exact", ids, x)
+    for q, (found, dists) in zip(queries, index.search_batch(queries, TOP_K)):
+        single, single_dists = index.search(q, TOP_K)
+        np.testing.assert_array_equal(found, single)
+        np.testing.assert_allclose(dists, single_dists, rtol=1e-3)
+
+
+@pytest.mark.parametrize("kind", ["exact", "ivf", "int8"])
+def test_candidates_restrict_the_search(data, kind):
+    ids, x, queries = data
+    index = make_index(kind, ids, x)
+    allowed = ids[::7]
+    mask = np.isin(ids, allowed)
+    for q in queries:
+        found, _ = index.search(q, TOP_K, allowed)
+        expected, _ = brute_force(ids[mask], x[mask], q, TOP_K)
+        np.testing.assert_array_equal(found, expected)
+
+
+@pytest.mark.parametrize("kind", ["exact", "ivf", "int8"])
+def test_tombstoned_chunks_are_masked(data, kind):
+    ids, x, queries = data
+    index = make_index(kind, ids, x)
+    q = queries[0]
+    expected, _ = brute_force(ids, x, q, TOP_K + 3)
+    index.delete(expected[:3])
+    found, _ = index.search(q, TOP_K)
+    # Still TOP_K results, the next closest
+    np.testing.assert_array_equal(found, expected[3:])
+    index.undelete(expected[:2])
+    found, _ = index.search(q, TOP_K)
+    assert set(expected[:2].tolist()) <= set(found.tolist())
+    assert expected[2] not in found
+
+
+def test_cache_add_skips_rows_the_load_saw(data):
+    ids, x, _ = data
+    # The upload's rows were committed before a query loaded the index
+    cache = IndexCache(1 << 30, loader=lambda user_id: ExactIndex(ids[:10], x[:10]), updater=None)
+    cache.get(7)
+    cache.add(7, ids[5:15], x[5:15])
+    chunk_ids = cache.get(7).chunk_ids()
+    assert len(chunk_ids) == len(set(chunk_ids.tolist())) == 15
@@ -0,0 +1,796 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from database import index_versions, tombstoned_chunk_ids
+from embedding_store import embedding_store
+from metrics import count, stage
+from quantization import RERANK_CANDIDATES, create_codec
+
+# Total memory the cached per-user indexes may use before the least recently
+# used ones are evicted (they are reloaded lazily on the next query).
+INDEX_MEMORY_BUDGET_MB = int(os.getenv("INDEX_MEMORY_BUDGET_MB", "512"))
+
+# Rows scored per block, keeps the temporary (block x dim) difference matrix small
+SCAN_BLOCK_ROWS = 16384
+
+# Index backend: "exact" (brute-force L2) or "ivf" (approximate, inverted file)
+INDEX_BACKEND = os.getenv("INDEX_BACKEND", "exact")
+
+# IVF knobs: number of coarse clusters, and how many of them a query scans.
+# Higher nprobe means better recall and slower queries.
+IVF_NLIST = int(os.getenv("IVF_NLIST", "256"))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "16"))
+# Vectors per cluster needed before the coarse quantizer is trained, and
+# the cap on the k-means training sample.
+IVF_MIN_POINTS_PER_LIST = 39
+IVF_MAX_POINTS_PER_LIST = 256
+IVF_KMEANS_ITERS = 10
+
+
+_NO_IDS = np.empty(0, dtype=np.int64)
+
+
+def drop_dead(ids, dists, dead, top_k):
+    # Tombstoned chunks are ranked like any other and dropped here; callers
+    # fetch top_k + len(dead) so that top_k live results remain
+    if len(dead):
+        live = ~np.isin(ids, dead)
+        ids, dists = ids[live], dists[live]
+    return ids[:top_k], dists[:top_k]
+
+
+class Tombstones:
+    """Deleted chunk ids an index masks out of its results."""
+
+    # Sorted ids of tombstoned chunks, replaced (never mutated) on change
+    _dead = _NO_IDS
+
+    @property
+    def dead_count(self):
+        return len(self._dead)
+
+    def delete(self, ids):
+        # Cost depends on the number of deleted ids only; the rows stay
+        # until compaction rewrites the user's segment
+        self._dead = np.union1d(self._dead, np.asarray(ids, dtype=np.int64))
+
+    def undelete(self, ids):
+        self._dead = np.setdiff1d(self._dead, np.asarray(ids, dtype=np.int64))
+
+    def replace_dead(self, ids):
+        # The full set, as read back from chunk_tombstones
+        self._dead = np.unique(np.asarray(ids, dtype=np.int64))
+
+
+class RowLookup:
+    """Chunk id -> row position of an index, so a candidate set (a lexical
+    prefilter, a file filter) is gathered in O(candidates log n) instead of
+    matching every row. Rebuilt on first use after rows were added.
+    """
+
+    def __init__(self, chunk_ids):
+        # Callable returning the index's chunk ids in row order
+        self._chunk_ids = chunk_ids
+        self._table = None
+
+    @property
+    def nbytes(self):
+        table = self._table
+        return table[1].nbytes + table[2].nbytes if table is not None else 0
+
+    def positions(self, ids, size):
+        # Sorted row positions (below `size`) of the given chunk ids that the index holds
+        table = self._table
+        if table is None or table[0] != size:
+            row_ids = self._chunk_ids()[:size]
+            order = np.argsort(row_ids, kind="stable")
+            table = self._table = (size, row_ids[order], order)
+        _, sorted_ids, order = table
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(sorted_ids) == 0 or len(ids) == 0:
+            return _NO_IDS
+        at = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+        return np.sort(order[at[sorted_ids[at] == ids]])
+
+
+class VectorIndex(Tombstones):
+    """Nearest-neighbour index over one user's chunk embeddings."""
+
+    size = 0
+
+    @property
+    def nbytes(self):
+        raise NotImplementedError
+
+    def chunk_ids(self):
+        raise NotImplementedError
+
+    def add(self, ids, vectors):
+        raise NotImplementedError
+
+    def search(self, q, top_k, candidates=None):
+        # Returns (chunk_ids, l2_distances), closest first. With `candidates`
+        # (chunk ids, e.g. from a lexical prefilter) only those rows are scored.
+        raise NotImplementedError
+
+    def search_batch(self, queries, top_k, candidates=None):
+        # One (chunk_ids, l2_distances) pair per query row
+        return [self.search(q, top_k, candidates) for q in np.asarray(queries, dtype=np.float32)]
+
+
+class ExactIndex(VectorIndex):
+    """Float32 embeddings plus a parallel chunk-id array, scanned exhaustively.
+
+    Rows live in two segments: an immutable base (typically a read-only
+    memmap of the user's on-disk segment, so loading copies nothing) and a
+    contiguous in-memory tail that later uploads append to.
+    """
+
+    def __init__(self, ids=None, matrix=None):
+        if ids is None or len(ids) == 0:
+            self._base_ids = np.empty(0, dtype=np.int64)
+            self._base = None
+        else:
+            self._base_ids = np.asarray(ids, dtype=np.int64)
+            self._base = np.asarray(matrix, dtype=np.float32)
+        self._ids = np.empty(0, dtype=np.int64)
+        self._matrix = None
+        self._tail_size = 0
+        self._lookup = RowLookup(self.chunk_ids)
+
+    @property
+    def size(self):
+        return len(self._base_ids) + self._tail_size
+
+    @property
+    def nbytes(self):
+        total = self._base_ids.nbytes
+        if self._base is not None:
+            total += self._base.nbytes
+        if self._matrix is not None:
+            total += self._matrix.nbytes + self._ids.nbytes
+        return total + self._lookup.nbytes
+
+    def chunk_ids(self):
+        if self._tail_size == 0:
+            return self._base_ids
+        return np.concatenate([self._base_ids, self._ids[:self._tail_size]])
+
+    def vectors(self):
+        tail = self._matrix[:self._tail_size] if self._tail_size else None
+        if tail is None:
+            return self._base if self._base is not None else np.empty((0, 0), dtype=np.float32)
+        if self._base is None:
+            return tail
+        return np.concatenate([self._base, tail])
+
+    def rows(self, positions):
+        # (chunk_ids, vectors) at insertion positions, base rows first, then the tail
+        positions = np.asarray(positions, dtype=np.int64)
+        if len(positions) == 0:
+            return _NO_IDS, np.empty((0, 0), dtype=np.float32)
+        base_rows = len(self._base_ids)
+        in_base = positions < base_rows
+        if in_base.all():
+            return self._base_ids[positions], np.asarray(self._base[positions])
+        tail = positions[~in_base] - base_rows
+        ids = np.empty(len(positions), dtype=np.int64)
+        vectors = np.empty((len(positions), self._matrix.shape[1]), dtype=np.float32)
+        ids[~in_base], vectors[~in_base] = self._ids[tail], self._matrix[tail]
+        if in_base.any():
+            ids[in_base], vectors[in_base] = self._base_ids[positions[in_base]], self._base[positions[in_base]]
+        return ids, vectors
+
+    def add(self, ids, vectors):
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+        if len(ids) == 0:
+            return
+        n, m = self._tail_size, len(ids)
+        if self._matrix is None or n + m > len(self._ids):
+            # Grow geometrically so repeated uploads stay amortised O(1) per row
+            capacity = max(n + m, 2 * len(self._ids), 64)
+            matrix = np.empty((capacity, vectors.shape[1]), dtype=np.float32)
+            new_ids = np.empty(capacity, dtype=np.int64)
+            if n:
+                matrix[:n] = self._matrix[:n]
+                new_ids[:n] = self._ids[:n]
+        else:
+            matrix, new_ids = self._matrix, self._ids
+        matrix[n:n + m] = vectors
+        new_ids[n:n + m] = ids
+        # Publish the arrays before the size so concurrent readers never see
+        # a size larger than the arrays they picked up.
+        self._matrix, self._ids = matrix, new_ids
+        self._tail_size = n + m
+
+    def search(self, q, top_k, candidates=None):
+        dead = self._dead
+        tail_size = self._tail_size
+        segments = [(self._base_ids, self._base, len(self._base_ids)),
+                    (self._ids, self._matrix, tail_size)]
+        n = len(self._base_ids) + tail_size
+        if n == 0 or top_k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        q = np.asarray(q, dtype=np.float32)
+        if candidates is not None:
+            candidates = np.setdiff1d(np.asarray(candidates, dtype=np.int64), dead)
+            return self._search_rows(q, top_k, n, candidates)
+        dists = np.empty(n, dtype=np.float32)
+        all_ids = np.empty(n, dtype=np.int64)
+        offset = 0
+        with stage("distance"):
+            for seg_ids, matrix, rows in segments:
+                for start in range(0, rows, SCAN_BLOCK_ROWS):
+                    diff = matrix[start:min(start + SCAN_BLOCK_ROWS, rows)] - q
+                    dists[offset + start:offset + start + len(diff)] = np.einsum("ij,ij->i", diff, diff)
+                all_ids[offset:offset + rows] = seg_ids[:rows]
+                offset += rows
+        count("chunks_scanned", n)
+        count("bytes_read", n * q.nbytes)
+        with stage("top_k"):
+            ids, dists = self._top(all_ids, dists, top_k + len(dead))
+        return drop_dead(ids, dists, dead, top_k)
+
+    def _search_rows(self, q, top_k, n, candidates):
+        # Only the candidate rows are gathered and scored
+        positions = self._lookup.positions(candidates, n)
+        if len(positions) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        ids, vectors = self.rows(positions)
+        count("chunks_scanned", len(ids))
+        count("bytes_read", vectors.nbytes)
+        diff = vectors - q
+        return self._top(ids, np.einsum("ij,ij->i", diff, diff), top_k)
+
+    def search_batch(self, queries, top_k, candidates=None):
+        # Scores every query against each block of rows with one matrix
+        # multiply, ||x||^2 - 2 q.x + ||q||^2, keeping a running top-k per query
+        tail_size = self._tail_size
+        segments = [(self._base_ids, self._base, len(self._base_ids)),
+                    (self._ids, self._matrix, tail_size)]
+        n = len(self._base_ids) + tail_size
+        dead = self._dead
+        if candidates is not None and n:
+            # Gather the candidate rows once for the whole batch
+            candidates = np.setdiff1d(np.asarray(candidates, dtype=np.int64), dead)
+            ids, vectors = self.rows(self._lookup.positions(candidates, n))
+            segments = [(ids, vectors, len(ids))]
+            n = len(ids)
+        queries = np.asarray(queries, dtype=np.float32)
+        m = len(queries)
+        if n == 0 or top_k <= 0:
+            return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))] * m
+        queries = queries.reshape(m, -1)
+
+        k = min(top_k + len(dead), n)
+        count("chunks_scanned", m * n)
+        count("bytes_read", n * queries.shape[1] * 4)
+        q_norms = np.einsum("ij,ij->i", queries, queries)[:, None]
+        best_d = np.empty((m, 0), dtype=np.float32)
+        best_pos = np.empty((m, 0), dtype=np.int64)
+        all_ids = np.empty(n, dtype=np.int64)
+        offset = 0
+        for seg_ids, matrix, rows in segments:
+            for start in range(0, rows, SCAN_BLOCK_ROWS):
+                block = matrix[start:min(start + SCAN_BLOCK_ROWS, rows)]
+                d = queries @ block.T
+                d *= -2.0
+                d += np.einsum("ij,ij->i", block, block)[None, :]
+                d += q_norms
+                pos = np.broadcast_to(np.arange(offset + start, offset + start + len(block)), d.shape)
+                d = np.concatenate([best_d, d], axis=1)
+                pos = np.concatenate([best_pos, pos], axis=1)
+                if d.shape[1] > k:
+                    keep = np.argpartition(d, k - 1, axis=1)[:, :k]
+                    d = np.take_along_axis(d, keep, axis=1)
+                    pos = np.take_along_axis(pos, keep, axis=1)
+                best_d, best_pos = d, pos
+            all_ids[offset:offset + rows] = seg_ids[:rows]
+            offset += rows
+
+        # Closest first, ties by insertion order as in search()
+        order = np.lexsort((best_pos, best_d), axis=-1)
+        best_d = np.sqrt(np.maximum(np.take_along_axis(best_d, order, axis=1), 0.0))
+        best_ids = all_ids[np.take_along_axis(best_pos, order, axis=1)]
+        return [drop_dead(ids, d, dead, top_k) for ids, d in zip(best_ids, best_d)]
+
+    @staticmethod
+    def _top(all_ids, dists, top_k):
+        n = len(dists)
+        k = min(top_k, n)
+        top = np.argpartition(dists, k - 1)[:k] if k < n else np.arange(n)
+        # Ties are broken by insertion order, like the stable sort this replaces
+        top = top[np.lexsort((top, dists[top]))]
+        return all_ids[top], np.sqrt(dists[top])
+
+
+def _squared_distances(x, centroids, centroid_norms):
+    # ||x - c||^2 for every (row, centroid) pair without materialising the differences
+    d = centroid_norms[None, :] - 2.0 * (x @ centroids.T)
+    d += np.einsum("ij,ij->i", x, x)[:, None]
+    return d
+
+
+def _assign(x, centroids):
+    norms = np.einsum("ij,ij->i", centroids, centroids)
+    labels = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), SCAN_BLOCK_ROWS):
+        block = x[start:start + SCAN_BLOCK_ROWS]
+        labels[start:start + len(block)] = _squared_distances(block, centroids, norms).argmin(axis=1)
+    return labels
+
+
+def kmeans(x, k, iters=IVF_KMEANS_ITERS, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+    for _ in range(iters):
+        labels = _assign(x, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, x)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        # Re-seed empty clusters on random points so every list gets used
+        empty = np.flatnonzero(~nonempty)
+        if len(empty):
+            centroids[empty] = x[rng.choice(len(x), size=len(empty), replace=False)]
+    return centroids
+
+
+class IVFIndex(VectorIndex):
+    """Inverted-file index: a k-means coarse quantizer routes each vector to one
+    of ``nlist`` exact sub-indexes and a query only scans the ``nprobe`` closest.
+
+    Until enough vectors have arrived to train the quantizer, everything lives
+    in a single exact index, so small users get exact results.
+    """
+
+    def __init__(self, nlist=IVF_NLIST, nprobe=IVF_NPROBE):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self._flat = ExactIndex()
+        # (centroids, lists) once trained; published as one tuple for concurrent readers
+        self._trained = None
+
+    @property
+    def size(self):
+        trained = self._trained
+        if trained is None:
+            return self._flat.size
+        return sum(lst.size for lst in trained[1])
+
+    @property
+    def nbytes(self):
+        trained = self._trained
+        if trained is None:
+            return self._flat.nbytes
+        centroids, lists = trained
+        return centroids.nbytes + sum(lst.nbytes for lst in lists)
+
+    def chunk_ids(self):
+        trained = self._trained
+        if trained is None:
+            return self._flat.chunk_ids()
+        return np.concatenate([lst.chunk_ids() for lst in trained[1]])
+
+    def add(self, ids, vectors):
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+        if len(ids) == 0:
+            return
+        if self._trained is None:
+            self._flat.add(ids, vectors)
+            if self._flat.size >= self.nlist * IVF_MIN_POINTS_PER_LIST:
+                self._train()
+            return
+        centroids, lists = self._trained
+        labels = _assign(vectors, centroids)
+        order = np.argsort(labels, kind="stable")
+        bounds = np.searchsorted(labels[order], np.arange(self.nlist + 1))
+        for lst_no in np.flatnonzero(np.diff(bounds)):
+            rows = order[bounds[lst_no]:bounds[lst_no + 1]]
+            lists[lst_no].add(ids[rows], vectors[rows])
+
+    def _train(self):
+        flat = self._flat
+        ids, x = flat.chunk_ids(), flat.vectors()
+        sample_size = min(len(x), self.nlist * IVF_MAX_POINTS_PER_LIST)
+        rng = np.random.default_rng(0)
+        sample = x[rng.choice(len(x), size=sample_size, replace=False)] if sample_size < len(x) else x
+        centroids = kmeans(sample, self.nlist)
+
+        lists = [ExactIndex() for _ in range(self.nlist)]
+        labels = _assign(x, centroids)
+        order = np.argsort(labels, kind="stable")
+        bounds = np.searchsorted(labels[order], np.arange(self.nlist + 1))
+        for lst_no in range(self.nlist):
+            rows = order[bounds[lst_no]:bounds[lst_no + 1]]
+            lists[lst_no].add(ids[rows], x[rows])
+        self._trained = (centroids, lists)
+        self._flat = ExactIndex()
+
+    def search(self, q, top_k, candidates=None, nprobe=None):
+        flat = self._flat
+        trained = self._trained
+        dead = self._dead
+        fetch = top_k + len(dead)
+        if trained is None:
+            return drop_dead(*flat.search(q, fetch, candidates), dead, top_k)
+
+        centroids, lists = trained
+        q = np.asarray(q, dtype=np.float32)
+        if candidates is not None:
+            # A prefiltered candidate set is small: score it exactly in every
+            # list instead of risking that its rows sit outside the probed ones
+            probe = np.arange(len(lists))
+        else:
+            nprobe = min(nprobe or self.nprobe, len(lists))
+            coarse = np.einsum("ij,ij->i", centroids - q, centroids - q)
+            probe = np.argpartition(coarse, nprobe - 1)[:nprobe] if nprobe < len(lists) else np.arange(len(lists))
+
+        found_ids, found_dists = [], []
+        for lst_no in probe:
+            ids, dists = lists[lst_no].search(q, fetch, candidates)
+            found_ids.append(ids)
+            found_dists.append(dists)
+        ids = np.concatenate(found_ids)
+        dists = np.concatenate(found_dists)
+        order = np.argsort(dists, kind="stable")[:fetch]
+        return drop_dead(ids[order], dists[order], dead, top_k)
+
+
+class QuantizedIndex(VectorIndex):
+    """Exhaustive scan over compressed codes, then an exact re-rank.
+
+    The codes (see quantization.py) sit in memory, row-aligned with a float32
+    ExactIndex whose base is the user's memory-mapped segment. A query scans
+    only the codes and reads the float32 rows of its ``rerank`` best
+    candidates to return exact distances; with ``rerank=0`` the distances are
+    the codec's approximations. A codec that needs training (PQ) trains once
+    ``min_train_rows`` vectors exist; until then the float32 rows are scanned.
+    """
+
+    def __init__(self, codec, ids=None, matrix=None, rerank=RERANK_CANDIDATES):
+        self.codec = codec
+        self.rerank = rerank
+        self._exact = ExactIndex(ids, matrix)
+        self._codes = None
+        # Rows encoded so far, published after the codes array
+        self._encoded = 0
+        self._encode_pending()
+
+    @property
+    def size(self):
+        return self._exact.size
+
+    @property
+    def nbytes(self):
+        # The memory-mapped float32 base is only paged in for re-ranked rows
+        exact = self._exact
+        total = exact.nbytes - (exact._base.nbytes if exact._base is not None else 0)
+        if self._codes is not None:
+            total += self._codes.nbytes
+        return total + self.codec.nbytes
+
+    def chunk_ids(self):
+        return self._exact.chunk_ids()
+
+    def add(self, ids, vectors):
+        self._exact.add(ids, vectors)
+        self._encode_pending()
+
+    def _encode_pending(self):
+        exact = self._exact
+        n, total = self._encoded, exact.size
+        if n == total:
+            return
+        if not self.codec.trained:
+            if total < self.codec.min_train_rows:
+                return
+            sample = np.arange(total)
+            if total > self.codec.max_train_rows:
+                sample = np.sort(np.random.default_rng(0).choice(total, size=self.codec.max_train_rows, replace=False))
+            self.codec.train(exact.rows(sample)[1])
+        codes = self._codes
+        for start in range(n, total, SCAN_BLOCK_ROWS):
+            stop = min(start + SCAN_BLOCK_ROWS, total)
+            encoded = self.codec.encode(exact.rows(np.arange(start, stop))[1])
+            if codes is None or stop > len(codes):
+                # Grow geometrically, like ExactIndex's tail
+                capacity = max(total, 2 * len(codes) if codes is not None else 0, 64)
+                grown = np.empty((capacity,) + encoded.shape[1:], dtype=encoded.dtype)
+                if codes is not None:
+                    grown[:start] = codes[:start]
+                codes = grown
+            codes[start:stop] = encoded
+        # Publish the codes before the count, readers take the count first
+        self._codes = codes
+        self._encoded = total
+
+    def search(self, q, top_k, candidates=None):
+        dead = self._dead
+        fetch = top_k + len(dead)
+        n = self._encoded
+        codes = self._codes
+        if n == 0 or candidates is not None:
+            # Untrained codec, or a prefiltered candidate set small enough to score exactly
+            return drop_dead(*self._exact.search(q, fetch, candidates), dead, top_k)
+        if top_k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        q = np.asarray(q, dtype=np.float32)
+        with stage("distance"):
+            prepared = self.codec.prepare(q)
+            dists = np.empty(n, dtype=np.float32)
+            for start in range(0, n, SCAN_BLOCK_ROWS):
+                stop = min(start + SCAN_BLOCK_ROWS, n)
+                dists[start:stop] = self.codec.distances(prepared, codes[start:stop])
+        count("chunks_scanned", n)
+        count("bytes_read", codes[:n].nbytes)
+        if not self.rerank:
+            np.maximum(dists, 0.0, out=dists)
+            with stage("top_k"):
+                positions, dists = ExactIndex._top(np.arange(n), dists, fetch)
+            return drop_dead(self._exact.rows(positions)[0], dists, dead, top_k)
+
+        with stage("top_k"):
+            positions, _ = ExactIndex._top(np.arange(n), dists, max(fetch, self.rerank))
+        ids, vectors = self._exact.rows(positions)
+        count("bytes_read", vectors.nbytes)
+        diff = vectors - q
+        exact = np.einsum("ij,ij->i", diff, diff)
+        order = np.lexsort((positions, exact))[:fetch]
+        return drop_dead(ids[order], np.sqrt(exact[order]), dead, top_k)
+
+
+def create_index(ids=None, matrix=None, backend=None, quantization=None):
+    backend = backend or INDEX_BACKEND
+    codec = create_codec(quantization)
+    if codec is not None:
+        if backend != "exact":
+            raise ValueError("VECTOR_QUANTIZATION only applies to INDEX_BACKEND=exact")
+        return QuantizedIndex(codec, ids, matrix)
+    if backend == "exact":
+        # Adopt the (possibly memory-mapped) rows as the base segment, no copy
+        return ExactIndex(ids, matrix)
+    if backend == "ivf":
+        index = IVFIndex()
+    else:
+        raise ValueError(f"Unknown index backend: {backend}")
+    if ids is not None and len(ids):
+        index.add(ids, matrix)
+    return index
+
+
+def load_user_index(user_id: int):
+    ids, matrix = embedding_store.load(user_id)
+    index = create_index(ids, matrix)
+    index.delete(tombstoned_chunk_ids(user_id))
+    return index
+
+
+def update_user_index(user_id: int, index, start):
+    """Catch a cached index up with the segment rows from ``start`` on and
+    the current tombstones. Returns the segment rows now seen."""
+    ids, matrix, rows = embedding_store.load_since(user_id, start)
+    # Rows this process appended were added to the index already
+    fresh = np.flatnonzero(~np.isin(ids, index.chunk_ids()))
+    if len(fresh):
+        index.add(ids[fresh], matrix[fresh])
+    index.replace_dead(tombstoned_chunk_ids(user_id))
+    return rows
+
+
+class IndexCache:
+    """LRU cache of per-user indexes, bounded by a memory budget in bytes.
+
+    ``loader(user_id)`` builds a user's index on first use; anything with
+    ``add(ids, items)``, ``delete(ids)``, ``undelete(ids)``,
+    ``replace_dead(ids)``, ``chunk_ids()`` and ``nbytes`` can be cached.
+
+    Each entry remembers the user's index_versions row it reflects and how
+    many rows of the user's embedding segment it has seen. ``refresh``
+    catches it up with changes committed by other processes through
+    ``updater(user_id, index, rows)``; after compaction (a new generation)
+    it is dropped and loaded again.
+    """
+
+    def __init__(self, budget_bytes, loader=load_user_index, updater=update_user_index, name="vector"):
+        self.budget_bytes = budget_bytes
+        self.loader = loader
+        self.updater = updater
+        self.name = name
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._generations = {}
+        self._rows = {}
+        self._loading = {}
+        self._load_locks = {}
+        # Serialise adds to a cached index; they run outside self._lock
+        self._write_locks = {}
+        self._lock = threading.Lock()
+        # user_id -> time.time() of the last query, for the warm-start snapshot
+        self.last_used = {}
+
+    def get(self, user_id: int, touch=True):
+        if touch:
+            self.last_used[user_id] = time.time()
+        index = self._lookup(user_id)
+        if index is not None:
+            return index
+
+        # One loader per user; concurrent queries for the same user wait for it
+        with self._lock:
+            load_lock = self._load_locks.setdefault(user_id, threading.Lock())
+        with load_lock:
+            index = self._lookup(user_id)
+            if index is not None:
+                return index
+            with self._lock:
+                pending = self._loading[user_id] = []
+
+            index = None
+            try:
+                # Read before loading: a change committed during the load makes
+                # the entry look stale (and reload), never the other way round
+                version, generation = index_versions([user_id])[user_id]
+                # Rows appended later are read again when catching up
+                rows = embedding_store.count(user_id)
+                with stage(f"{self.name}_index_load"):
+                    index = self.loader(user_id)
+                # Replay adds and deletes committed while we were reading.
+                # Outside self._lock, as an add may train the index; the
+                # entry is published once nothing is left to replay.
+                applied = 0
+                while True:
+                    with self._lock:
+                        replay = pending[applied:]
+                        # None marks an invalidation during the load; the
+                        # index still answers this query but is not kept
+                        if not replay or None in replay:
+                            del self._loading[user_id]
+                            if not replay:
+                                self._entries[user_id] = index
+                                self._versions[user_id] = version
+                                self._generations[user_id] = generation
+                                self._rows[user_id] = rows
+                                self._evict(keep=user_id)
+                            break
+                    for apply in replay:
+                        apply(index)
+                    applied += len(replay)
+            except BaseException:
+                with self._lock:
+                    self._loading.pop(user_id, None)
+                raise
+        return index
+
+    def _lookup(self, user_id):
+        with self._lock:
+            index = self._entries.get(user_id)
+            if index is not None:
+                self._entries.move_to_end(user_id)
+            return index
+
+    def add(self, user_id: int, ids, vectors):
+        ids = np.asarray(ids, dtype=np.int64)
+        # Vectors, or chunk texts (object array) for the lexical index
+        vectors = np.asarray(vectors)
+
+        def apply(index):
+            # Skip chunks the index already holds: a load or refresh() that
+            # ran after the commit read them from the segment
+            fresh = ~np.isin(ids, index.chunk_ids())
+            if fresh.any():
+                index.add(ids[fresh], vectors[fresh])
+
+        with self._lock:
+            if user_id in self._loading:
+                self._loading[user_id].append(apply)
+            index = self._entries.get(user_id)
+            if index is None:
+                # Not loaded yet, the next query maps the rows from the embedding store
+                return
+            write_lock = self._write_lock(user_id)
+        # Crossing the IVF or PQ training threshold runs k-means here, so
+        # only this user's writers wait; queries keep reading the index,
+        # which publishes the trained structures in one assignment
+        with write_lock:
+            apply(index)
+        with self._lock:
+            self._evict(keep=user_id)
+
+    def delete(self, user_id: int, ids):
+        self._apply(user_id, lambda index: index.delete(ids))
+
+    def undelete(self, user_id: int, ids):
+        self._apply(user_id, lambda index: index.undelete(ids))
+
+    def _apply(self, user_id, apply):
+        with self._lock:
+            if user_id in self._loading:
+                self._loading[user_id].append(apply)
+            index = self._entries.get(user_id)
+            if index is None:
+                return
+            write_lock = self._write_lock(user_id)
+        # Ordered with refresh(), which replaces the tombstones it read
+        with write_lock:
+            apply(index)
+
+    def _write_lock(self, user_id):
+        # Under self._lock
+        return self._write_locks.setdefault(user_id, threading.Lock())
+
+    def _drop(self, user_id):
+        # Under self._lock; returns the entry
+        self._versions.pop(user_id, None)
+        self._generations.pop(user_id, None)
+        self._rows.pop(user_id, None)
+        return self._entries.pop(user_id, None)
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._drop(user_id)
+            if user_id in self._loading:
+                self._loading[user_id].append(None)
+
+    def advance(self, user_id: int, version):
+        # This process committed ``version`` and applied it to the cached
+        # index; only a gap-free step is trusted, anything else is left for
+        # refresh to catch up
+        with self._lock:
+            if user_id in self._entries and self._versions.get(user_id) == version - 1:
+                self._versions[user_id] = version
+
+    def refresh(self, versions):
+        """Bring entries up to ``versions`` ({user_id: (version, generation)},
+        from the database). Entries of an older generation are dropped and
+        loaded again on the next query, the others catch up in place.
+        Returns the user ids whose entries changed."""
+        with self._lock:
+            changed = [(user_id, version, generation) for user_id, (version, generation) in versions.items()
+                       if user_id in self._entries and self._versions.get(user_id) != version]
+            behind = []
+            for user_id, version, generation in changed:
+                if self.updater is None or self._generations.get(user_id) != generation:
+                    self._drop(user_id)
+                else:
+                    behind.append((user_id, version, self._entries[user_id], self._rows[user_id],
+                                   self._write_lock(user_id)))
+        for user_id, version, index, rows, write_lock in behind:
+            # Queries keep using the index meanwhile, as with uploads
+            with write_lock:
+                with stage(f"{self.name}_index_catch_up"):
+                    rows = self.updater(user_id, index, rows)
+            with self._lock:
+                if self._entries.get(user_id) is index:
+                    self._rows[user_id] = rows
+                    # advance() may have moved past the version read
+                    self._versions[user_id] = max(self._versions[user_id], version)
+                    self._evict(keep=user_id)
+        return [user_id for user_id, _, _ in changed]
+
+    def users(self):
+        with self._lock:
+            return list(self._entries)
+
+    def memory_usage(self):
+        with self._lock:
+            return sum(index.nbytes for index in self._entries.values())
+
+    def _evict(self, keep):
+        total = sum(index.nbytes for index in self._entries.values())
+        for user_id in list(self._entries):
+            if total <= self.budget_bytes:
+                break
+            if user_id == keep:
+                continue
+            total -= self._drop(user_id).nbytes
+
+
+user_indexes = IndexCache(INDEX_MEMORY_BUDGET_MB * 1024 * 1024)